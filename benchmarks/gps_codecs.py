@@ -0,0 +1,47 @@
+"""
+Compare write/read throughput and compression ratio of the gps codecs.
+
+    python benchmarks/gps_codecs.py [ncoords] [ncells]
+"""
+
+from mdprep import gps
+
+import numpy as np
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def bench(path, vector, **kws):
+    t0 = time.time()
+    gps.save(path, vector, **kws)
+    t1 = time.time()
+    gps.load(path)
+    t2 = time.time()
+    return t1 - t0, t2 - t1, os.path.getsize(path)
+
+def main(ncoords=100000, ncells=3):
+    vector = np.random.RandomState(42).normal(size=(ncells, ncoords, 3))
+    mbytes = vector.nbytes / 2.**20
+    codecs = [None] + sorted(c for c in gps.CODECS if c != 'xz' or gps.lzma is not None)
+    tmp    = tempfile.mkdtemp()
+    try:
+        print '%-8s %-6s %10s %10s %8s' % ('format', 'codec', 'write MB/s', 'read MB/s', 'ratio')
+        for binary in (False, True):
+            raw = None
+            for codec in codecs:
+                path = os.path.join(tmp, 'bench.gps' + ('.' + codec if codec else ''))
+                write, read, size = bench(path, vector, binary=binary, codec=codec)
+                raw = raw or size
+                print '%-8s %-6s %10.1f %10.1f %8.2f' % (
+                    'binary' if binary else 'text', codec or '-',
+                    mbytes / write, mbytes / read, raw / float(size))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
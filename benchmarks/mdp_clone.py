@@ -0,0 +1,61 @@
+"""
+Compare copy-on-write MDP.copy() with a full per-group deep copy on a
+parameter sweep where each clone changes a couple of keys.
+
+    python benchmarks/mdp_clone.py [nclones]
+"""
+
+from mdprep import mdp_defaults
+from mdprep.mdp import MDP
+
+import copy
+import gc
+import sys
+import time
+
+
+def deep_sizeof(objs):
+    """
+    Bytes held by `objs` and everything reachable from them, counting
+    shared objects once
+    """
+    seen  = set()
+    todo  = list(objs)
+    total = 0
+    while todo:
+        o = todo.pop()
+        if id(o) in seen or isinstance(o, type): continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        todo.extend(gc.get_referents(o))
+    return total
+
+def full_copy(mdp):
+    o = MDP()
+    for g in mdp._groups:
+        o.add(copy.deepcopy(g))
+    return o
+
+def sweep(clone, base, n):
+    clones = list()
+    for i in xrange(n):
+        m = clone(base)
+        m.seed(i)
+        m.nsteps = 1000 * i
+        clones.append(m)
+    return clones
+
+def main(n=10000):
+    base = mdp_defaults.explicit_solvent()
+    base.format() # warm up
+    print '%-10s %10s %12s' % ('clone', 'seconds', 'MB')
+    for name, clone in [('deepcopy', full_copy), ('cow', MDP.copy)]:
+        t0 = time.time()
+        clones = sweep(clone, base, n)
+        t1 = time.time()
+        size = deep_sizeof(clones) - deep_sizeof([base])
+        print '%-10s %10.3f %12.1f' % (name, t1 - t0, size / 2.**20)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
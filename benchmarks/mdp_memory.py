@@ -0,0 +1,33 @@
+"""
+Memory held by many MDPs parsed from text, as when loading the runs of a
+large experiment, and by as many copy-on-write clones.
+
+    python benchmarks/mdp_memory.py [nmdps]
+"""
+
+from mdprep import mdp_defaults
+from mdprep.mdp import MDP
+
+from mdp_clone import deep_sizeof
+
+import sys
+
+
+def main(n=10000):
+    base = mdp_defaults.explicit_solvent()
+    texts = list()
+    for i in xrange(n):
+        m = base.copy()
+        m.seed(i)
+        texts.append(m.format())
+
+    print '%-10s %12s %12s' % ('mdps', 'MB', 'bytes/mdp')
+    for name, build in [('parsed', lambda: map(MDP.loads, texts)),
+                        ('clones', lambda: [base.copy() for _ in xrange(n)])]:
+        mdps = build()
+        size = deep_sizeof(mdps + [base] + texts) - deep_sizeof([base] + texts)
+        print '%-10s %12.1f %12.0f' % (name, size / 2.**20, size / float(n))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,39 @@
+"""
+Compare writing a seed sweep with MDP.save against MDPTemplate.save_many.
+
+    python benchmarks/mdp_sweep.py [nfiles] [threads]
+"""
+
+from mdprep import mdp_defaults
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def main(n=10000, threads=0):
+    base = mdp_defaults.explicit_solvent()
+    tmp  = tempfile.mkdtemp()
+    try:
+        t0 = time.time()
+        for i in xrange(n):
+            m = base.copy()
+            m.seed(i)
+            m.save(os.path.join(tmp, 'save%d.mdp' % i))
+        t1 = time.time()
+        tpl = base.template(['ld_seed'])
+        tpl.save_many(((os.path.join(tmp, 'tpl%d.mdp' % i), dict(ld_seed=i))
+                       for i in xrange(n)),
+                      threads=threads)
+        t2 = time.time()
+        print '%-10s %10s %12s' % ('method', 'seconds', 'files/s')
+        print '%-10s %10.3f %12.0f' % ('save', t1 - t0, n / (t1 - t0))
+        print '%-10s %10.3f %12.0f' % ('template', t2 - t1, n / (t2 - t1))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
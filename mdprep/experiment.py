@@ -65,7 +65,7 @@ class GromacsRun(Run):
         logger.debug('Loading MDP from', typ)
 
         if typ is str:
-            return mdp.MDP.loads(self.mdp)
+            return mdp.MDP.loads_cached(self.mdp)
 
         elif typ is types.FunctionType:
             return self.mdp()
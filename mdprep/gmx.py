@@ -1,7 +1,16 @@
 from pxul.command import OptCommand
 from pxul.os import SetEnv
+from pxul.logging import logger
 
+from . import _yaml as yaml
+
+import hashlib
 import os
+import re
+import shutil
+import stat
+import subprocess
+import tempfile
 
 __all__ = [
     'NoAutobackup',
@@ -11,13 +20,284 @@ __all__ = [
     'genion',
     'genbox',
     'mdrun',
+    'CommandCache',
 ]
 
 NoAutobackup = SetEnv(GMX_MAXBACKUP=-1)
 
+
+def _sha1_file(path, bufsize=2**20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(bufsize), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _snapshot(directory='.'):
+    """
+    Map the names of the files in `directory` to their (size, mtime)
+    """
+    files = dict()
+    for name in os.listdir(directory):
+        st = os.stat(os.path.join(directory, name))
+        if stat.S_ISREG(st.st_mode):
+            files[name] = (st.st_size, st.st_mtime)
+    return files
+
+
+def _includes(path, seen=None):
+    """
+    The files #include'd by the topology at `path`, recursively, that are
+    found relative to it.  Those from the force field directories are
+    identified by the GROMACS installation instead.
+    """
+    seen = set() if seen is None else seen
+    with open(path) as fd:
+        for line in fd:
+            m = re.match(r'\s*#include\s+"([^"]+)"', line)
+            if not m: continue
+            inc = os.path.join(os.path.dirname(path), m.group(1))
+            if inc in seen or not os.path.isfile(inc): continue
+            seen.add(inc)
+            _includes(inc, seen)
+    return seen
+
+# tool -> installation identity, see _tool_identity
+_identities = dict()
+
+def _tool_identity(tool):
+    """
+    Identify the installation of the GROMACS `tool`: the executable found on
+    the PATH, the build information it reports and the GMX* environment
+    """
+    if tool not in _identities:
+        ident = list()
+        for d in os.environ.get('PATH', '').split(os.pathsep):
+            exe = os.path.join(d, tool)
+            if os.path.isfile(exe) and os.access(exe, os.X_OK):
+                exe = os.path.realpath(exe)
+                st  = os.stat(exe)
+                ident.append('%s:%d:%r' % (exe, st.st_size, st.st_mtime))
+                break
+        try:
+            with open(os.devnull) as null:
+                p = subprocess.Popen([tool, '-version'], stdin=null,
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                out = p.communicate()[0]
+            # skip the parts that change between runs, eg the closing quote
+            ident.extend(l.strip() for l in out.splitlines()
+                         if re.match(r'\s*(gromacs version|precision|git sha1|built on|.*library)', l, re.I))
+        except OSError: pass
+        _identities[tool] = ident
+    env = ['%s=%s' % kv for kv in sorted(os.environ.iteritems()) if kv[0].startswith('GMX')]
+    return '\n'.join(_identities[tool] + env)
+
+
+class CommandCache(object):
+    """
+    Directory of the outputs of GROMACS tool invocations, shared between
+    preparations.
+
+    An invocation is keyed by the tool and its installation (executable,
+    version and GMX* environment), its arguments and the contents of the
+    existing files it is given, including the files topologies #include,
+    so the same inputs under different paths hit the same entry.  The
+    outputs are the files the tool creates or modifies in the working
+    directory and in the directories of the paths it is given.  On a hit
+    they are materialized at the same paths (relative to the working
+    directory, unless outside of it) by copying, or by hardlinking with
+    `link=True`, which is only safe if nothing edits them in place
+    afterwards, and the recorded result of the tool is returned.
+    The least recently used entries are evicted once the directory holds
+    more than `max_bytes`.
+
+    Only the `commands` named are cached, by default every tool but mdrun.
+    Use as a context manager to cache the GmxCommands called within:
+
+        with CommandCache('/scratch/gmx-cache'):
+            gmx.pdb2gmx(f='protein.pdb', o='conf.gro', p='topol.top')
+    """
+    version  = 2
+    commands = ('pdb2gmx', 'editconf', 'genbox', 'genion', 'grompp')
+
+    def __init__(self, directory, max_bytes=2**34, link=False, commands=None):
+        self.directory = os.path.abspath(directory) # tools run in other directories
+        self.max_bytes = max_bytes
+        self.link      = link
+        self.commands  = set(self.commands if commands is None else commands)
+        self.hits      = 0
+        self.misses    = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __enter__(self):
+        _caches.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _caches.remove(self)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses)
+
+    def _value(self, v):
+        """
+        The key of the argument `v`: existing files are keyed by content
+        """
+        if not (isinstance(v, str) and os.path.isfile(v)):
+            return repr(v)
+        path, v = v, 'file:' + _sha1_file(v)
+        if os.path.splitext(path)[1] in ('.top', '.itp'):
+            for inc in sorted(_includes(path)):
+                rel = os.path.relpath(inc, os.path.dirname(path))
+                v  += ' %s:%s' % (rel, _sha1_file(inc))
+        return v
+
+    def key(self, name, args, kws):
+        h = hashlib.sha1('%s:%d\n' % (name, self.version))
+        h.update(_tool_identity(name) + '\n')
+        for a in args:
+            h.update(self._value(a) + '\n')
+        for k in sorted(kws):
+            h.update('%s=%s\n' % (k, self._value(kws[k])))
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def _directories(self, args, kws):
+        """
+        The directories a tool may write to: the working directory and those
+        of the paths among its arguments
+        """
+        dirs = set([os.curdir])
+        for v in list(args) + kws.values():
+            if isinstance(v, str) and os.path.isdir(os.path.dirname(v) or os.curdir):
+                dirs.add(os.path.dirname(v) or os.curdir)
+        return dirs
+
+    def _files(self, directories):
+        """
+        Map the paths of the files in `directories` to their (size, mtime).
+        Paths are relative to the working directory unless outside of it.
+        """
+        files = dict()
+        for d in directories:
+            for name, st in _snapshot(d).iteritems():
+                path = os.path.relpath(os.path.join(d, name))
+                if path.startswith(os.pardir):
+                    path = os.path.abspath(path)
+                files[path] = st
+        return files
+
+    def _materialize(self, src, dst):
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        elif os.path.dirname(dst) and not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        if self.link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError: pass
+        shutil.copy2(src, dst)
+
+    def get(self, key):
+        """
+        Materialize the outputs of `key` relative to the working directory.
+        Returns the manifest (the 'files' and the 'result' of the tool) or
+        None on a miss.
+        """
+        path = os.path.join(self._entry(key), 'outputs.yaml')
+        if not os.path.exists(path):
+            return None
+        with open(path) as fd:
+            manifest = yaml.safe_load(fd)
+        for i, name in enumerate(manifest['files']):
+            self._materialize(os.path.join(self._entry(key), 'files', str(i)), name)
+        os.utime(path, None) # mark as recently used
+        return manifest
+
+    def put(self, key, names, result):
+        try:
+            manifest = yaml.safe_dump(dict(files=sorted(names), result=result),
+                                      default_flow_style=False)
+        except yaml.YAMLError:
+            logger.debug('Not caching %s: unable to store the result %r' % (key, result))
+            return
+        tmp = tempfile.mkdtemp(dir=self.directory, suffix='.tmp')
+        try:
+            os.mkdir(os.path.join(tmp, 'files'))
+            for i, name in enumerate(sorted(names)):
+                shutil.copy2(name, os.path.join(tmp, 'files', str(i)))
+            with open(os.path.join(tmp, 'outputs.yaml'), 'w') as fd:
+                fd.write(manifest)
+            os.rename(tmp, self._entry(key))
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(self._entry(key)):
+                raise
+        self.evict()
+
+    def call(self, command, args, kws):
+        if command.tool not in self.commands:
+            return command.uncached(*args, **kws)
+        key      = self.key(command.tool, args, kws)
+        manifest = self.get(key)
+        if manifest is not None:
+            self.hits += 1
+            logger.info1('Reusing cached %s outputs: %s' % (command.tool, ' '.join(manifest['files'])))
+            return manifest['result']
+        self.misses += 1
+        dirs   = self._directories(args, kws)
+        before = self._files(dirs)
+        result = command.uncached(*args, **kws)
+        after  = self._files(dirs)
+        self.put(key, [n for n in after if before.get(n) != after[n]], result)
+        return result
+
+    def _size(self, path):
+        total = 0
+        for root, _, files in os.walk(path):
+            total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        return total
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        """
+        entries = list()
+        for name in os.listdir(self.directory):
+            manifest = os.path.join(self.directory, name, 'outputs.yaml')
+            if name.endswith('.tmp') or not os.path.exists(manifest): continue
+            p = os.path.join(self.directory, name)
+            entries.append((os.stat(manifest).st_mtime, self._size(p), p))
+        total = sum(e[1] for e in entries)
+        for _, size, p in sorted(entries):
+            if total <= self.max_bytes: break
+            shutil.rmtree(p, ignore_errors=True)
+            total -= size
+
+# the active CommandCaches, innermost last
+_caches = list()
+
+
 class GmxCommand(OptCommand):
     def __init__(self, cmd):
         OptCommand.__init__(self, cmd, short_flag_prefix='-', long_flag_prefix='-')
+        self.tool = cmd
+
+    def uncached(self, *args, **kws):
+        """
+        Run the tool, bypassing any CommandCache
+        """
+        return OptCommand.__call__(self, *args, **kws)
+
+    def __call__(self, *args, **kws):
+        if _caches:
+            return _caches[-1].call(self, args, kws)
+        return self.uncached(*args, **kws)
 
 pdb2gmx  = GmxCommand('pdb2gmx')
 editconf = GmxCommand('editconf')
@@ -1,5 +1,8 @@
 from . import gmx
+from .gmx import _sha1_file, _snapshot
+from . import mdp
 from . import mdp_defaults
+from . import _yaml as yaml
 
 import pxul
 from pxul.logging import logger
@@ -8,9 +11,15 @@ import mdtraj
 import prody
 prody.confProDy(verbosity='critical')
 import textwrap
+import collections
+import hashlib
+import itertools
+import math
+import multiprocessing
+import time
+import traceback
 import os
 import shutil
-import copy
 
 
 def count_occurences(string, lines):
@@ -57,10 +66,258 @@ class suffix(object):
 
 
 
+def _param_digest(value):
+    """
+    A string identifying a stage argument: MDPs by their content hash,
+    existing files by the hash of their contents
+    """
+    if isinstance(value, mdp.MDP):
+        return 'MDP:' + value.content_hash()
+    elif isinstance(value, dict):
+        return '{%s}' % ', '.join('%s: %s' % (k, _param_digest(value[k])) for k in sorted(value))
+    elif isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(map(_param_digest, value))
+    elif isinstance(value, str) and os.path.isfile(value):
+        return 'file:' + _sha1_file(value)
+    else:
+        return repr(value)
+
+
+class _NoCache(object):
+    def __enter__(self): return self
+    def __exit__(self, *exc): pass
+
+
+class StageCheckpoints(object):
+    """
+    Manifests of the completed stages of a preparation, kept in `directory`
+    (relative to the workarea).
+
+    A stage is identified by a key hashing its name, arguments (MDP content,
+    input file contents) and the key and outputs of the stage before it.
+    When a stage runs, the files it creates or modifies are recorded with
+    their hashes; a later run with the same key whose recorded outputs are
+    unchanged skips the stage and restores the state it left behind.
+    The `scratch` files every grompp call rewrites are not recorded.
+    """
+    scratch = ('mdout.mdp',)
+
+    def __init__(self, directory='.checkpoints'):
+        self.directory = directory
+        self.chain     = '' # digest of the previous stage and its outputs
+        self.skipped   = list()
+        self.ran       = list()
+
+    def _path(self, stage):
+        return os.path.join(self.directory, stage + '.yaml')
+
+    def load(self, stage):
+        path = self._path(stage)
+        if not os.path.exists(path):
+            return None
+        with open(path) as fd:
+            return yaml.safe_load(fd)
+
+    def save(self, stage, manifest):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp = self._path(stage) + '.tmp'
+        with open(tmp, 'w') as fd:
+            yaml.safe_dump(manifest, fd, default_flow_style=False)
+        os.rename(tmp, self._path(stage))
+
+    def discard(self, stage):
+        path = self._path(stage)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def key(self, stage, params):
+        h = hashlib.sha1()
+        h.update(stage + '\n' + self.chain + '\n')
+        h.update(_param_digest(params))
+        return h.hexdigest()
+
+    def verify(self, outputs):
+        """
+        Whether the recorded `outputs` are still present and unchanged
+        """
+        for name, rec in outputs.iteritems():
+            if not os.path.isfile(name):
+                return False
+            st = os.stat(name)
+            if st.st_size != rec['size']:
+                return False
+            if st.st_mtime != rec['mtime'] and _sha1_file(name) != rec['sha1']:
+                return False
+        return True
+
+    def _release(self, stage, names):
+        """
+        Files rewritten by `stage` are no longer outputs of any other stage
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for entry in os.listdir(self.directory):
+            other = os.path.splitext(entry)[0]
+            if other == stage or not entry.endswith('.yaml'):
+                continue
+            manifest = self.load(other)
+            dropped  = [n for n in names if n in manifest['outputs']]
+            for n in dropped:
+                del manifest['outputs'][n]
+            if dropped:
+                self.save(other, manifest)
+
+    def run(self, prep, stage, fn, *args, **kws):
+        """
+        Call `fn(*args, **kws)` as `stage` of `prep` unless its checkpoint
+        is up to date
+        """
+        key = self.key(stage, dict(args=args, kws=kws))
+        manifest = self.load(stage)
+        if manifest is not None and manifest['key'] == key and self.verify(manifest['outputs']):
+            logger.info1('Skipping %s: checkpoint is up to date' % stage)
+            prep._cn, prep._pn, prep._top = manifest['state']
+            self.chain = manifest['chain']
+            self.skipped.append(stage)
+            return
+
+        self.discard(stage)
+        before = _snapshot()
+        fn(*args, **kws)
+        outputs = dict()
+        for name, (size, mtime) in _snapshot().iteritems():
+            if before.get(name) != (size, mtime) and name not in self.scratch:
+                outputs[name] = dict(size=size, mtime=mtime, sha1=_sha1_file(name))
+        self._release(stage, outputs)
+
+        chain = hashlib.sha1(key)
+        for name in sorted(outputs):
+            chain.update(name + ':' + outputs[name]['sha1'] + '\n')
+        self.chain = chain.hexdigest()
+        self.save(stage, dict(stage    = stage,
+                              key      = key,
+                              chain    = self.chain,
+                              state    = [prep._cn, prep._pn, prep._top],
+                              outputs  = outputs))
+        self.ran.append(stage)
+
+
+def _gro_atoms(path):
+    """
+    The number of atoms in the .gro file at `path`
+    """
+    with open(path) as fd:
+        fd.readline() # title
+        return int(fd.readline())
+
+
+Allocation = collections.namedtuple('Allocation', 'pid tool stage natoms cores offset flags waited')
+
+class CoreScheduler(object):
+    """
+    A node-wide budget of `cores` shared by concurrent preparations: in
+    this process, or in pool workers started with CoreScheduler.initializer
+    (the budget lives in shared memory and cannot be pickled).
+
+    Each mdrun gets a contiguous block of cores, one per `atoms_per_core`
+    atoms of its input up to `max_cores`, and is pinned to it with
+    `ntomp` OpenMP threads per rank; stages in `stage_cores` get a fixed
+    count instead (vacuum minimization runs on a single core as before).
+    grompp holds a single core.  Callers wait until their block is free.
+    """
+    stage_cores = dict(minimize_vacuum=1)
+
+    def __init__(self, cores=None, atoms_per_core=1000, max_cores=None, ntomp=1):
+        self.cores          = cores or multiprocessing.cpu_count()
+        self.atoms_per_core = atoms_per_core
+        self.max_cores      = max_cores or self.cores
+        self.ntomp          = ntomp
+        self._owners        = multiprocessing.Array('i', self.cores, lock=False) # pid using each core
+        self._cond          = multiprocessing.Condition()
+
+    def size(self, tool, stage, natoms):
+        """
+        The number of cores for running `tool` on `natoms` atoms in `stage`
+        """
+        if tool != 'mdrun':
+            return 1
+        n = self.stage_cores.get(stage)
+        if n is None:
+            n = int(math.ceil(natoms / float(self.atoms_per_core)))
+        return max(1, min(n, self.max_cores, self.cores))
+
+    def _alive(self, pid):
+        try:
+            os.kill(pid, 0)
+            return True
+        except OSError:
+            return False
+
+    def _find(self, n):
+        """
+        The first core of a free block of `n`, reclaiming the cores of dead processes
+        """
+        run = 0
+        for i in xrange(self.cores):
+            pid = self._owners[i]
+            if pid and not self._alive(pid):
+                self._owners[i] = pid = 0
+            run = run + 1 if pid == 0 else 0
+            if run == n:
+                return i - n + 1
+        return None
+
+    def acquire(self, tool, stage, natoms):
+        n  = self.size(tool, stage, natoms)
+        t0 = time.time()
+        with self._cond:
+            offset = self._find(n)
+            while offset is None:
+                self._cond.wait(1)
+                offset = self._find(n)
+            for i in xrange(offset, offset + n):
+                self._owners[i] = os.getpid()
+        if tool == 'mdrun':
+            flags = dict(nt=n, ntomp=self.ntomp, pin='on', pinoffset=offset)
+        else:
+            flags = dict()
+        return Allocation(os.getpid(), tool, stage, natoms, n, offset, flags, time.time() - t0)
+
+    def release(self, allocation):
+        with self._cond:
+            for i in xrange(allocation.offset, allocation.offset + allocation.cores):
+                self._owners[i] = 0
+            self._cond.notify_all()
+
+    def usage(self):
+        """
+        The pid using each core, 0 if free
+        """
+        return list(self._owners)
+
+    @staticmethod
+    def initializer(scheduler):
+        global _scheduler
+        _scheduler = scheduler
+
+# the CoreScheduler of a pool worker, see CoreScheduler.initializer
+_scheduler = None
+
+
 class PrepareSolvatedSystem(object):
-    def __init__(self, workarea='mdprep'):
+    def __init__(self, workarea='mdprep', checkpoint=True, cache=None, scheduler=None):
         self.name     = None
         self.workarea = workarea
+        self.checkpoint  = checkpoint # skip stages whose outputs are up to date
+        self.checkpoints = None       # StageCheckpoints of the last prepare()
+        # gmx.CommandCache (or its directory) shared with other preparations
+        if cache is not None and not isinstance(cache, gmx.CommandCache):
+            cache = gmx.CommandCache(cache)
+        self.cache    = cache
+        self.scheduler   = scheduler  # CoreScheduler shared with other preparations
+        self.allocations = list()     # the Allocations made for our gmx calls
+        self._stage_name = None
         self._cn      = None      # current name
         self._pn      = None      # previous name
         self._top     = None      # path to topology file
@@ -74,6 +331,43 @@ class PrepareSolvatedSystem(object):
     @property
     def top(self): return self._top
 
+    def _cached(self):
+        return self.cache if self.cache is not None else _NoCache()
+
+    def __getstate__(self):
+        # a CoreScheduler reaches pool workers through its initializer
+        state = dict(self.__dict__)
+        state['scheduler'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.scheduler = _scheduler
+
+    def _gmx(self, tool, conf=None, **kws):
+        """
+        Call the gmx `tool`, within the core budget of the scheduler if any.
+        `conf` is the input structure, used to size mdrun.
+        """
+        if self.scheduler is None:
+            return tool(**kws)
+        natoms = _gro_atoms(conf) if conf is not None else None
+        alloc  = self.scheduler.acquire(tool.tool, self._stage_name, natoms)
+        self.allocations.append(alloc)
+        logger.debug('Running', tool.tool, 'on', alloc.cores, 'cores from', alloc.offset)
+        kws.update(alloc.flags)
+        try:
+            return tool(**kws)
+        finally:
+            self.scheduler.release(alloc)
+
+    def _stage(self, stage, fn, *args, **kws):
+        self._stage_name = stage
+        if self.checkpoints is None:
+            fn(*args, **kws)
+        else:
+            self.checkpoints.run(self, stage, fn, *args, **kws)
+
     def initialize(self, pdb, ff='amber03', water='tip3p', ignh=True):
         logger.info1('Importing to GMX format')
         top = suffix.top(self.cn)
@@ -95,13 +389,13 @@ class PrepareSolvatedSystem(object):
         mdp_path = suffix.mdp(self.cn)
         mdp.save(mdp_path)
         tpr = suffix.tpr(cn)
-        gmx.grompp(
+        self._gmx(gmx.grompp,
             f = mdp_path,
             c = suffix.gro(pn),
             p = suffix.top(pn),
             o = tpr
             )
-        gmx.mdrun(
+        self._gmx(gmx.mdrun, suffix.gro(pn),
             s      = tpr,
             deffnm = cn,
             c      = suffix.pdb(cn),
@@ -125,13 +419,16 @@ class PrepareSolvatedSystem(object):
             d = boxdist,
             )
         self._cn = nwat
+        # genbox edits the topology in place: keep the one from initialize intact
+        shutil.copy(self.top, suffix.top(nwat))
+        self._top = suffix.top(nwat)
         gmx.genbox(
             cp = suffix.gro(nbox),
             cs = solv,
             p  = self.top,
             o  = suffix.gro(self.cn)
             )
-        gmx.grompp(
+        self._gmx(gmx.grompp,
             f = suffix.mdp(self.pn),
             c = suffix.gro(self.cn),
             p = self.top,
@@ -195,13 +492,13 @@ class PrepareSolvatedSystem(object):
         mdp_path = suffix.mdp(self.cn)
         mdp.save(mdp_path)
         tpr = suffix.tpr(self.cn)
-        gmx.grompp(
+        self._gmx(gmx.grompp,
             f = mdp_path,
             c = suffix.gro(self.cn),
             p = self.top,
             o = tpr
             )
-        gmx.mdrun(
+        self._gmx(gmx.mdrun, suffix.gro(self.cn),
             s      = tpr,
             deffnm = self.cn,
             )
@@ -213,7 +510,6 @@ class PrepareSolvatedSystem(object):
         gammas = [1000, 100, 10, 1] if gammas is None else gammas
         name = self.name + '_itr_posres_eq'
 
-        mdp_itr = suffix.mdp(name)
         mdp.SETUP.define = '-DPOSRES'
         if steps is not None:
             mdp.nsteps = steps
@@ -224,24 +520,28 @@ class PrepareSolvatedSystem(object):
             mdp.set_gamma(g)
             logger.debug('using gamma =', g)
             logger.debug('using dt =', mdp.dt)
-            mdp.save(mdp_itr)
-
-            self._cn = name + '_gamma-%d' % g
-            gmx.grompp(
-                f = mdp_itr,
-                c = suffix.gro(self.pn),
-                t = suffix.trr(self.pn),
-                p = self.top,
-                o = suffix.tpr(self.cn)
-                )
-            gmx.mdrun(
-                s      = suffix.tpr(self.cn),
-                deffnm = self.cn,
-                v      = True
-                )
-            self._pn = self.cn
+            self._stage('relax_gamma-%d' % g, self._relax_gamma, mdp, name, g)
             mdp.unset_velocity_generation()
 
+    def _relax_gamma(self, mdp, name, g):
+        self._cn = name + '_gamma-%d' % g
+        mdp_itr = suffix.mdp(self.cn)
+        mdp.save(mdp_itr)
+
+        self._gmx(gmx.grompp,
+            f = mdp_itr,
+            c = suffix.gro(self.pn),
+            t = suffix.trr(self.pn),
+            p = self.top,
+            o = suffix.tpr(self.cn)
+            )
+        self._gmx(gmx.mdrun, suffix.gro(self.pn),
+            s      = suffix.tpr(self.cn),
+            deffnm = self.cn,
+            v      = True
+            )
+        self._pn = self.cn
+
     def equilibrate(self, mdp, steps=None):
         logger.info1('Equilibrating')
         self._cn = self.name + '_eq'
@@ -251,20 +551,72 @@ class PrepareSolvatedSystem(object):
         mdp.unset_velocity_generation()
         mdp.save(mdp_path)
 
-        gmx.grompp(
+        self._gmx(gmx.grompp,
             f = mdp_path,
             c = suffix.gro(self.pn),
             t = suffix.trr(self.pn),
             p = self.top,
             o = suffix.tpr(self.cn)
             )
-        gmx.mdrun(
+        self._gmx(gmx.mdrun, suffix.gro(self.pn),
             s      = suffix.tpr(self.cn),
             deffnm = self.cn,
             v      = True
             )
 
 
+    def _mdps(self, mdp_min_vac, mdp_min_sol, mdp_run):
+        mdp_min_vac = mdp_defaults.minimize_vacuum()   if mdp_min_vac is None else mdp_min_vac.copy()
+        mdp_min_sol = mdp_defaults.minimize_solvated() if mdp_min_sol is None else mdp_min_sol.copy()
+        mdp_run     = mdp_defaults.explicit_solvent()  if mdp_run     is None else mdp_run.copy()
+        return mdp_min_vac, mdp_min_sol, mdp_run
+
+    def _prepare_system(self, pdb, ff, water, ignh, mdp_min_vac, mdp_min_sol):
+        """
+        The seed-independent stages, in the workarea
+        """
+        self._stage('initialize', self.initialize, pdb, ff=ff, water=water, ignh=ignh)
+        self._stage('minimize_vacuum', self.minimize_vacuum, mdp_min_vac)
+        self._stage('solvate', self.solvate, mdp_min_sol)
+
+    def _prepare_run(self, mdp_run, iter_gammas, iter_steps, eq_steps):
+        """
+        The seed-dependent stages, in the workarea
+        """
+        self.relax(mdp_run.copy(), gammas=iter_gammas, steps=iter_steps)
+        self._stage('equilibrate', self.equilibrate, mdp_run.copy(), steps=eq_steps)
+
+    def _write_outputs(self, name, mdp_run, workarea, outdir=''):
+        """
+        Copy the prepared system from `workarea` to `outdir` and create the run tpr
+        """
+        if not name:
+            name = self.name
+
+        out  = lambda path: os.path.join(outdir, path)
+        conf = out(suffix.gro(name)), suffix.gro(self.pn)
+        top  = out(suffix.top(name)), self.top
+        itp  = out(suffix.itp(name)), 'posre.itp'
+        mdp  = out(suffix.mdp(name))
+
+        for new, old in [conf, top, itp]:
+            shutil.copy(os.path.join(workarea, old), new)
+            logger.info1('Saved file %s' % os.path.abspath(new))
+
+        with open(mdp, 'w') as fd:
+            fd.write(str(mdp_run))
+            logger.info1('Saved file', os.path.abspath(fd.name))
+
+        # create tpr with velocities
+        logger.info1('Creating run tpr')
+        conf  = conf[0]
+        top   = top[0]
+        mdout = out(suffix.mdp('{}_mdout'.format(name)))
+        tpr   = out(suffix.tpr(name))
+        self._gmx(gmx.grompp, f=mdp, c=conf, po=mdout, p=top, o=tpr, t=suffix.trr(os.path.join(workarea, self.pn)))
+
+        return dict(conf=conf,top=top,mdout=mdout,tpr=tpr)
+
     def prepare(self,
                 pdb,
                 ff             = 'amber03',
@@ -276,8 +628,12 @@ class PrepareSolvatedSystem(object):
                 iter_gammas    = None,
                 iter_steps     = 500,
                 eq_steps       = 500,
-                seed           = None):
-
+                seed           = None,
+                outdir         = ''):
+        """
+        Prepare `pdb` in the workarea and write the prepared system and run
+        tpr to `outdir` (the current directory by default)
+        """
 
         cwd = os.getcwd()
         logger.info('Preparing %s with %s in %s' % (os.path.relpath(pdb, cwd), ff, cwd))
@@ -286,9 +642,7 @@ class PrepareSolvatedSystem(object):
         wa  = os.path.join(self.workarea)
         name = os.path.splitext(os.path.basename(pdb))[0]
 
-        mdp_min_vac = mdp_defaults.minimize_vacuum()   if mdp_min_vac is None else mdp_min_vac.copy()
-        mdp_min_sol = mdp_defaults.minimize_solvated() if mdp_min_sol is None else mdp_min_sol.copy()
-        mdp_run     = mdp_defaults.explicit_solvent()  if mdp_run     is None else mdp_run.copy()
+        mdp_min_vac, mdp_min_sol, mdp_run = self._mdps(mdp_min_vac, mdp_min_sol, mdp_run)
 
         if seed is not None:
             mdp_run.seed(seed)
@@ -296,35 +650,173 @@ class PrepareSolvatedSystem(object):
         self.name = name
         self._cn  = name
 
-        with pxul.os.StackDir(wa):
-            self.initialize(pdb, ff=ff, water=water, ignh=ignh)
-            self.minimize_vacuum(mdp_min_vac)
-            self.solvate(mdp_min_sol)
-            self.relax(copy.deepcopy(mdp_run), gammas=iter_gammas, steps=iter_steps)
-            self.equilibrate(copy.deepcopy(mdp_run), steps=eq_steps)
-
-        if not name:
-            name = self.name
-
-        conf = suffix.gro(name), suffix.gro(self.pn)
-        top  = suffix.top(name), self.top
-        itp  = suffix.itp(name), 'posre.itp'
-        mdp  = suffix.mdp(name)
+        with pxul.os.StackDir(wa), self._cached():
+            self.checkpoints = StageCheckpoints() if self.checkpoint else None
+            self._prepare_system(pdb, ff, water, ignh, mdp_min_vac, mdp_min_sol)
+            self._prepare_run(mdp_run, iter_gammas, iter_steps, eq_steps)
+
+        if outdir and not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        self._stage_name = 'run'
+        return self._write_outputs(name, mdp_run, self.workarea, outdir)
+
+    def prepare_seeds(self,
+                      pdb,
+                      seeds,
+                      ff             = 'amber03',
+                      water          = 'tip3p',
+                      ignh           = True,
+                      mdp_min_vac    = None,
+                      mdp_min_sol    = None,
+                      mdp_run        = None,
+                      iter_gammas    = None,
+                      iter_steps     = 500,
+                      eq_steps       = 500,
+                      outdir         = 'seed-%d',
+                      processes      = None):
+        """
+        Like prepare(), once for each of `seeds`, but topology building,
+        solvation and minimization run only once.  Relaxation, equilibration
+        and the run tpr then branch per seed in <workarea>/seed-<seed>, in a
+        pool of `processes` if given.  The outputs of each seed go to
+        `outdir % seed`.
+        Returns a prepare() result dict per seed, with the 'seed' and the
+        'allocations' of its branch added.
+        """
+        cwd = os.getcwd()
+        logger.info('Preparing %s with %s in %s for %d seeds' % (os.path.relpath(pdb, cwd), ff, cwd, len(seeds)))
 
-        for new, old in [conf, top, itp]:
-            shutil.copy(os.path.join(self.workarea, old), new)
-            logger.info1('Saved file %s' % os.path.abspath(new))
+        pdb = os.path.abspath(pdb)
+        wa  = os.path.abspath(self.workarea)
+        name = os.path.splitext(os.path.basename(pdb))[0]
 
-        with open(mdp, 'w') as fd:
-            fd.write(str(mdp_run))
-            logger.info1('Saved file', os.path.abspath(fd.name))
+        mdp_min_vac, mdp_min_sol, mdp_run = self._mdps(mdp_min_vac, mdp_min_sol, mdp_run)
 
-        # create tpr with velocities
-        logger.info1('Creating run tpr')
-        conf  = conf[0]
-        top   = top[0]
-        mdout = suffix.mdp('{}_mdout'.format(name))
-        tpr   = suffix.tpr(name)
-        gmx.grompp(f=mdp, c=conf, po=mdout, p=top, o=tpr, t=suffix.trr(os.path.join(self.workarea, self.pn)))
+        self.name = name
+        self._cn  = name
 
-        return dict(conf=conf,top=top,mdout=mdout,tpr=tpr)
+        with pxul.os.StackDir(wa), self._cached():
+            self.checkpoints = StageCheckpoints() if self.checkpoint else None
+            self._prepare_system(pdb, ff, water, ignh, mdp_min_vac, mdp_min_sol)
+
+        branch = dict(shared      = wa,
+                      state       = (self._cn, self._pn, self._top),
+                      chain       = self.checkpoints.chain if self.checkpoints else None,
+                      mdp_run     = mdp_run,
+                      iter_gammas = iter_gammas,
+                      iter_steps  = iter_steps,
+                      eq_steps    = eq_steps,
+                      outdir      = outdir)
+        jobs = [(self, seed, branch) for seed in seeds]
+
+        if processes:
+            pool = multiprocessing.Pool(processes, CoreScheduler.initializer, (self.scheduler,))
+            try:
+                return pool.map(_prepare_seed, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        return map(_prepare_seed, jobs)
+
+    def _prepare_seed(self, seed, shared, state, chain, mdp_run, iter_gammas, iter_steps, eq_steps, outdir):
+        mdp_run = mdp_run.copy()
+        mdp_run.seed(seed)
+        self._cn, self._pn, self._top = state
+        first = len(self.allocations)
+
+        # the branch reads the solvated system and the topology (with the
+        # itp files it includes) from the shared stages through symlinks
+        wa = os.path.join(shared, 'seed-%d' % seed)
+        if not os.path.isdir(wa):
+            os.makedirs(wa)
+        inputs = [suffix.gro(self.pn), suffix.trr(self.pn), self.top]
+        inputs.extend(n for n in os.listdir(shared) if n.endswith('.itp'))
+        for name in inputs:
+            link = os.path.join(wa, name)
+            if os.path.lexists(link):
+                os.unlink(link)
+            os.symlink(os.path.join(os.pardir, name), link)
+
+        with pxul.os.StackDir(wa), self._cached():
+            self.checkpoints = StageCheckpoints() if self.checkpoint else None
+            if self.checkpoints is not None:
+                self.checkpoints.chain = chain
+            self._prepare_run(mdp_run, iter_gammas, iter_steps, eq_steps)
+
+        outdir = outdir % seed
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        self._stage_name = 'run'
+        result = self._write_outputs(self.name, mdp_run, wa, outdir)
+        result['seed'] = seed
+        result['allocations'] = self.allocations[first:]
+        return result
+
+
+def _prepare_seed((prep, seed, branch)):
+    return prep._prepare_seed(seed, **branch)
+
+
+PrepareReport = collections.namedtuple('PrepareReport', 'pdb workarea result error seconds allocations')
+
+def _prepare_one(args):
+    pdb, workarea, outdir, prep_kws, kws = args
+    t0   = time.time()
+    prep = PrepareSolvatedSystem(workarea=workarea, **prep_kws)
+    prep.scheduler = prep.scheduler or _scheduler
+    try:
+        result = prep.prepare(pdb, outdir=outdir, **kws)
+        error  = None
+    except Exception:
+        result = None
+        error  = traceback.format_exc()
+    return PrepareReport(pdb, workarea, result, error, time.time() - t0, prep.allocations)
+
+def prepare_many(pdbs, workarea='mdprep', outdir='.', processes=None,
+                 checkpoint=True, cache=None, scheduler=None, **kws):
+    """
+    Prepare each of `pdbs` in a pool of `processes` workers.  A system
+    named <name> works in <workarea>/<name> and writes its outputs to
+    <outdir>/<name>; the remaining keywords are passed to prepare().
+    With a CoreScheduler the workers share its core budget.
+    Returns a PrepareReport per pdb, in the order they finish.  A failed
+    preparation has no result and the traceback as its error.
+    """
+    pdbs      = map(os.path.abspath, pdbs)
+    processes = processes or multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(pdbs)))
+    prep_kws  = dict(checkpoint=checkpoint, cache=cache)
+
+    work  = list()
+    names = collections.Counter()
+    for pdb in pdbs:
+        name = os.path.splitext(os.path.basename(pdb))[0]
+        names[name] += 1
+        if names[name] > 1:
+            name += '-%d' % names[name]
+        work.append((pdb,
+                     os.path.join(os.path.abspath(workarea), name),
+                     os.path.join(os.path.abspath(outdir), name),
+                     prep_kws, kws))
+
+    if processes == 1:
+        prep_kws['scheduler'] = scheduler
+        reports = itertools.imap(_prepare_one, work)
+        pool    = None
+    else:
+        pool    = multiprocessing.Pool(processes, CoreScheduler.initializer, (scheduler,))
+        reports = pool.imap_unordered(_prepare_one, work)
+
+    done = list()
+    try:
+        for r in reports:
+            if r.error is None:
+                logger.info('Prepared %s in %.1fs' % (r.pdb, r.seconds))
+            else:
+                logger.warn('Failed to prepare %s after %.1fs:\n%s' % (r.pdb, r.seconds, r.error))
+            done.append(r)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return done
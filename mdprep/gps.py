@@ -5,13 +5,23 @@ Import/export utilities functions for guamps (gps) format.
 
 import numpy as np
 
+import bz2
+import gzip
 import re
+import tempfile
 import textwrap
+import warnings
 from cStringIO import StringIO
 
-def write_array(fd, vector, fmt='%f'):
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
-    # find the dimensions
+def _dimensions(vector):
     shape = vector.shape
     if len(shape) == 1:
         ncells, ncoords, ndims = 1, len(vector), 1
@@ -22,22 +32,110 @@ def write_array(fd, vector, fmt='%f'):
         ncells, ncoords, ndims = shape
     else:
         raise ValueError, 'Unknown shape {}'.format(shape)
+    return ncells, ncoords, ndims
+
+# number of values formatted at a time by write_array
+WRITE_CHUNK = 2**16
+
+def _format_chunk(fmt, chunk):
+    return ((fmt + '\n') * len(chunk)) % tuple(chunk.tolist())
+
+def write_array(fd, vector, fmt='%f', chunksize=None):
+    """
+    Write `vector` in the text gps format, one value per line.
+    The values are formatted and written `chunksize` at a time.
+    """
+
+    # find the dimensions
+    ncells, ncoords, ndims = _dimensions(vector)
 
     # format and write
+    fd.write(_header(ncells, ncoords, ndims))
+    _write_text(fd, np.ravel(vector), fmt, chunksize)
+
+def _header(ncells, ncoords, ndims, dtype=None, width=0):
+    """
+    The text of the gps header.  `width` pads the ncells field so it can be
+    rewritten in place.  With a `dtype` this is the padded binary header.
+    """
     header = textwrap.dedent("""\
-        ncells: {}
+        ncells: {:>{}}
         ncoords: {}
         ndims: {}
+        """.format(ncells, width, ncoords, ndims))
+    if dtype is None:
+        return header + '\n'
+    header += 'dtype: {}\n'.format(np.dtype(dtype).str)
+    padding = -(len(header) + 1) % BINARY_ALIGNMENT
+    return header + ' ' * padding + '\n'
+
+def _write_text(fd, values, fmt, chunksize=None):
+    chunksize = chunksize or WRITE_CHUNK
+    for i in xrange(0, values.size, chunksize):
+        fd.write(_format_chunk(fmt, values[i:i + chunksize]))
+
+# the binary header is padded so the data starts at a multiple of this
+BINARY_ALIGNMENT = 64
 
-        """.format(ncells, ncoords, ndims))
+def write_binary_array(fd, vector, dtype=None):
+    """
+    Write `vector` in the binary gps format: the text header with an extra
+    `dtype` line (including endianness, e.g. '<f8'), padded to
+    BINARY_ALIGNMENT bytes, followed by the raw C-ordered data.
+    """
+    ncells, ncoords, ndims = _dimensions(vector)
+    vector = np.ascontiguousarray(vector, dtype=dtype)
+    fd.write(_header(ncells, ncoords, ndims, dtype=vector.dtype))
+    _write_binary(fd, vector)
 
-    fd.write(header)
-    np.savetxt(fd, vector.flatten(), fmt=fmt)
+# number of bytes moved at a time through non-file (e.g. compressed) streams
+STREAM_CHUNK = 2**22
+
+def _write_binary(fd, vector):
+    if isinstance(fd, file):
+        vector.tofile(fd)
+        return
+    data = np.ravel(vector).view(np.uint8)
+    for i in xrange(0, data.size, STREAM_CHUNK):
+        fd.write(data[i:i + STREAM_CHUNK].tostring())
 
 def write_scalar(fd, val):
     fd.write(str(val))
 
-def read_array(fd):
+def read_array(fd, memmap=False):
+    """
+    Read an array in either the text or the binary gps format.
+    Binary data is read with np.fromfile from files (memory-mapped read-only
+    if `memmap` is set) and in chunks into the result from other streams.
+    """
+    shape, dtype = _read_header(fd)
+    if dtype is not None:
+        return _read_binary(fd, shape, dtype, memmap)
+
+    if not _seekable(fd):
+        # keep the text for the np.loadtxt fallback
+        fd = StringIO(fd.read())
+    start = fd.tell()
+    try:
+        array = _read_text(fd, shape)
+    except ValueError:
+        # malformed input: let np.loadtxt parse or report it
+        fd.seek(start)
+        array = np.loadtxt(fd)
+    return array.reshape(shape)
+
+def _seekable(fd):
+    try:
+        fd.seek(fd.tell())
+        return True
+    except (IOError, OSError, AttributeError):
+        return False
+
+def _read_header(fd):
+    """
+    Returns the (ncells, ncoords, ndims) shape and the dtype, which is None
+    for the text format.  Leaves `fd` at the start of the data.
+    """
     def match_header(name):
         line = fd.readline()
         match = re.match(r'{}: *(\d+)'.format(name), line)
@@ -48,10 +146,262 @@ def read_array(fd):
     ncells = match_header('ncells')
     ncoords = match_header('ncoords')
     ndims = match_header('ndims')
-    fd.readline()
+    shape = (ncells, ncoords, ndims)
+    line = fd.readline()
+
+    match = re.match(r'dtype: *(\S+)', line)
+    if match:
+        fd.readline() # padding
+        return shape, np.dtype(match.group(1))
+    return shape, None
+
+# number of characters parsed at a time by the text reader
+TEXT_CHUNK = 2**22
+
+def _read_text(fd, shape, chunksize=None):
+    """
+    Parse the whitespace-separated values into an array preallocated from
+    the header, one chunk of text at a time.
+    Raises ValueError if the data does not hold exactly the expected count.
+    """
+    chunksize = chunksize or TEXT_CHUNK
+    count = shape[0] * shape[1] * shape[2]
+    array = np.empty(count, dtype=np.float64)
+    pos   = 0
+    tail  = ''
+    with warnings.catch_warnings():
+        # numpy warns when a token cannot be parsed, make that an error
+        warnings.simplefilter('error')
+        while True:
+            chunk = fd.read(chunksize)
+            text  = tail + chunk
+            if chunk:
+                # keep a possibly partial last token for the next chunk
+                cut  = max(text.rfind(' '), text.rfind('\n'), text.rfind('\t'))
+                text, tail = text[:cut + 1], text[cut + 1:]
+            if text.strip():
+                try:
+                    values = np.fromstring(text, dtype=np.float64, sep=' ')
+                except (DeprecationWarning, ValueError):
+                    raise ValueError, 'Malformed gps data'
+                if pos + len(values) > count:
+                    raise ValueError, 'Expected {} values, found more'.format(count)
+                array[pos:pos + len(values)] = values
+                pos += len(values)
+            if not chunk: break
+    if pos != count:
+        raise ValueError, 'Expected {} values, found {}'.format(count, pos)
+    return array
+
+def _read_binary(fd, shape, dtype, memmap):
+    count = shape[0] * shape[1] * shape[2]
+    if isinstance(fd, file) and memmap:
+        offset = fd.tell()
+        array  = np.memmap(fd.name, dtype=dtype, mode='r', offset=offset, shape=shape)
+        fd.seek(offset + count * dtype.itemsize)
+        return array
+    elif isinstance(fd, file):
+        array = np.fromfile(fd, dtype=dtype, count=count)
+    else:
+        array = _read_chunked(fd, dtype, count)
+    if array.size != count:
+        raise ValueError, 'Expected {} values, found {}'.format(count, array.size)
+    return array.reshape(shape)
+
+def _read_chunked(fd, dtype, count):
+    """
+    Read `count` values from a stream into a preallocated array so the peak
+    memory stays near the size of the result
+    """
+    array = np.empty(count, dtype=dtype)
+    data  = array.view(np.uint8)
+    pos   = 0
+    while pos < data.size:
+        chunk = fd.read(min(STREAM_CHUNK, data.size - pos))
+        if not chunk: break
+        data[pos:pos + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+        pos += len(chunk)
+    return array[:pos // dtype.itemsize]
+
+class ArrayWriter(object):
+    """
+    Write a gps array one cell of shape (ncoords, ndims) at a time.
+    The ncells header field is written with a fixed width and patched when
+    the writer is closed.  If `fd` cannot be rewound (pipes, compressed
+    streams) the cells are spooled to a temporary file instead and written
+    after the header on close.  Passing a `dtype` selects the binary format.
+
+        with ArrayWriter(open('x.gps', 'w'), ncoords, 3) as w:
+            for frame in frames:
+                w.append(frame)
+    """
+    NCELLS_WIDTH = 20
+
+    def __init__(self, fd, ncoords, ndims=1, fmt='%f', dtype=None):
+        self._fd     = fd
+        self._fmt    = fmt
+        self._dtype  = None if dtype is None else np.dtype(dtype)
+        self.ncoords = ncoords
+        self.ndims   = ndims
+        self.ncells  = 0
+        # gzip streams seek forward only
+        if _seekable(fd) and not isinstance(fd, gzip.GzipFile):
+            self._out   = fd
+            self._start = fd.tell()
+            fd.write(_header(0, ncoords, ndims, dtype=self._dtype, width=self.NCELLS_WIDTH))
+        else:
+            self._out   = tempfile.TemporaryFile()
+
+    def append(self, cell):
+        cell = np.asarray(cell)
+        if cell.size != self.ncoords * self.ndims:
+            raise ValueError, 'Expected a cell of shape {}, got {}'.format((self.ncoords, self.ndims), cell.shape)
+        if self._dtype is None:
+            _write_text(self._out, np.ravel(cell), self._fmt)
+        else:
+            _write_binary(self._out, np.ascontiguousarray(cell, dtype=self._dtype))
+        self.ncells += 1
+
+    def close(self):
+        header = _header(self.ncells, self.ncoords, self.ndims, dtype=self._dtype, width=self.NCELLS_WIDTH)
+        if self._out is self._fd:
+            end = self._fd.tell()
+            self._fd.seek(self._start)
+            self._fd.write(header)
+            self._fd.seek(end)
+        elif not self._out.closed:
+            self._fd.write(header)
+            self._out.seek(0)
+            for chunk in iter(lambda: self._out.read(STREAM_CHUNK), ''):
+                self._fd.write(chunk)
+            self._out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ArrayReader(object):
+    """
+    Read the cells of a gps array lazily, in order or by index.
+    Binary cells are located by arithmetic; text cells (one value per line,
+    as written by write_array) through an offset index built on demand.
+    """
+    def __init__(self, fd):
+        self._fd    = fd
+        shape, self._dtype = _read_header(fd)
+        self.ncells, self.ncoords, self.ndims = shape
+        self._start   = fd.tell()
+        self._offsets = [self._start] # byte offset of each text cell seen so far
+
+    def __len__(self):
+        return self.ncells
+
+    @property
+    def _cellsize(self):
+        return self.ncoords * self.ndims
+
+    def _read_cell(self):
+        n = self._cellsize
+        if self._dtype is not None:
+            if isinstance(self._fd, file):
+                values = np.fromfile(self._fd, dtype=self._dtype, count=n)
+            else:
+                values = np.frombuffer(self._fd.read(n * self._dtype.itemsize), dtype=self._dtype)
+        else:
+            lines  = [self._fd.readline() for _ in xrange(n)]
+            values = np.fromstring(''.join(lines), dtype=np.float64, sep=' ')
+        if values.size != n:
+            raise ValueError, 'Expected {} values, found {}'.format(n, values.size)
+        return values.reshape((self.ncoords, self.ndims))
+
+    def _seek(self, k):
+        if self._dtype is not None:
+            self._fd.seek(self._start + k * self._cellsize * self._dtype.itemsize)
+            return
+        # extend the text offset index up to cell k
+        self._fd.seek(self._offsets[-1])
+        while len(self._offsets) <= k:
+            for _ in xrange(self._cellsize):
+                self._fd.readline()
+            self._offsets.append(self._fd.tell())
+        self._fd.seek(self._offsets[k])
 
-    array = np.loadtxt(fd)
-    return array.reshape((ncells, ncoords, ndims))
+    def cell(self, k):
+        if k < 0: k += self.ncells
+        if not 0 <= k < self.ncells:
+            raise IndexError, k
+        self._seek(k)
+        return self._read_cell()
+
+    def __getitem__(self, k):
+        return self.cell(k)
+
+    def __iter__(self):
+        self._seek(0)
+        for k in xrange(self.ncells):
+            yield self._read_cell()
+            if self._dtype is None and len(self._offsets) == k + 1:
+                self._offsets.append(self._fd.tell())
+
+
+def _open_xz(path, mode):
+    if lzma is None:
+        raise ValueError, 'xz compression requires the lzma module'
+    return lzma.LZMAFile(path, mode)
+
+# codec: (file suffix, magic bytes, opener)
+CODECS = {
+    'gz' : ('.gz',  '\x1f\x8b',          lambda path, mode: gzip.GzipFile(path, mode)),
+    'bz2': ('.bz2', 'BZh',               lambda path, mode: bz2.BZ2File(path, mode)),
+    'xz' : ('.xz',  '\xfd7zXZ\x00',      _open_xz),
+}
+
+def _detect_codec(path):
+    with open(path, 'rb') as fd:
+        magic = fd.read(6)
+    for name, (_, prefix, _) in CODECS.iteritems():
+        if magic.startswith(prefix):
+            return name
+    return None
+
+def open_file(path, mode='r', codec=None):
+    """
+    Open a possibly compressed gps file.
+    When reading, the codec is detected from the magic bytes of the file.
+    When writing it is `codec` if given, otherwise inferred from the suffix
+    of `path` (.gz, .bz2 or .xz).  Compressed streams are decompressed
+    incrementally by read_array.
+    """
+    if 'r' in mode:
+        codec = _detect_codec(path)
+    elif codec is None:
+        for name, (suffix, _, _) in CODECS.iteritems():
+            if path.endswith(suffix):
+                codec = name
+    if codec is None:
+        return open(path, mode + 'b' if 'b' not in mode else mode)
+    return CODECS[codec][2](path, mode.replace('b', '') + 'b')
+
+def load(path, memmap=False):
+    """
+    Read the array stored at `path` in any gps format or codec
+    """
+    with open_file(path) as fd:
+        return read_array(fd, memmap=memmap)
+
+def save(path, vector, fmt='%f', dtype=None, binary=False, codec=None):
+    """
+    Write `vector` to `path`, in the binary format if `binary` or `dtype`
+    is given, compressed according to `codec` or the suffix of `path`
+    """
+    with open_file(path, 'w', codec=codec) as fd:
+        if binary or dtype is not None:
+            write_binary_array(fd, vector, dtype=dtype)
+        else:
+            write_array(fd, vector, fmt=fmt)
 
 def read_scalar(fd, mktype):
     return mktype(fd.readline().strip())
@@ -74,11 +424,20 @@ def _with_stringio(creator, retval, fn, *args, **kws):
 def array2str(vector, fmt='%f'):
     return _with_stringio(StringIO, 'str', lambda fd: write_array(fd, vector, fmt=fmt))
 
+def array2bin(vector, dtype=None):
+    return _with_stringio(StringIO, 'str', lambda fd: write_binary_array(fd, vector, dtype=dtype))
+
 def scalar2str(val):
     return _with_stringio(StringIO, 'str', lambda fd: write_scalar(fd, val))
 
 def str2array(s):
     return _with_stringio(lambda: StringIO(s), 'cont', read_array)
 
+def bin2array(s):
+    """
+    Same as str2array, which detects the binary format on its own
+    """
+    return str2array(s)
+
 def str2scalar(s, mktype):
     return _with_stringio(lambda: StringIO(s), 'cont', lambda fd: read_scalar(fd, mktype))
@@ -5,12 +5,15 @@ from pxul.StringIO import StringIO
 import os
 import collections
 import copy
+import hashlib
+from multiprocessing.pool import ThreadPool
 from . import _yaml as yaml
 
 __all__ = [
     'velocity_generation_group',
     'MdpGroup',
     'MDP',
+    'MDPTemplate',
     ]
 
 def velocity_generation_group(temp, seed):
@@ -22,20 +25,99 @@ def velocity_generation_group(temp, seed):
     return g
 
 
+def _format_value(v):
+    ### cases: value is list of str, str, arbitrary
+
+    # [str]: stringify
+    if type(v) is list:
+        return ' '.join(map(str, v))
+
+    # str: write
+    elif type(v) is str:
+        return v
+
+    # obj:
+    else:
+        return str(v)
+
+
+def _canonical_value(v):
+    """
+    Whitespace-separated tokens of `v`, with numbers in a single spelling
+    so that eg 300, '300' and '300.0' compare equal
+    """
+    tokens = list()
+    for t in _format_value(v).split():
+        try:
+            t = repr(float(t))
+        except ValueError: pass
+        tokens.append(t)
+    return ' '.join(tokens)
+
+
+class _Layout(object):
+    """
+    The ordered keys of an MdpGroup.  Layouts are interned so that groups
+    with the same keys share one instance, see _intern_layout.
+    """
+    __slots__ = ('keys', 'index', '_extended')
+
+    def __init__(self, keys):
+        self.keys      = keys
+        self.index     = dict((k, i) for i, k in enumerate(keys))
+        self._extended = dict()
+
+    def extend(self, key):
+        """
+        The layout with `key` appended
+        """
+        try:
+            return self._extended[key]
+        except KeyError:
+            l = _intern_layout(self.keys + (key,))
+            self._extended[key] = l
+            return l
+
+_layouts = dict()
+
+def _intern_layout(keys):
+    l = _layouts.get(keys)
+    if l is None:
+        l = _layouts[keys] = _Layout(keys)
+    return l
+
+
 class MdpGroup(object):
+    __slots__ = ('descr', '_layout', '_values', '_comments', '_owner')
+
     def __init__(self, description=None):
         # self.__setattr__ is overridden below which causes infinit recursion.
         # use object.__setattr__ to work around this
         object.__setattr__(self, 'descr', description)
-        object.__setattr__(self, '_kv',  collections.OrderedDict())
-        object.__setattr__(self, '_line_comments', dict())
+        object.__setattr__(self, '_layout', _intern_layout(()))
+        object.__setattr__(self, '_values', list()) # in the order of _layout.keys
+        object.__setattr__(self, '_comments', None) # key -> line comment
+        object.__setattr__(self, '_owner', None) # the MDP indexing our keys
 
 
     def set(self, key, val):
-        self._kv[key] = val
+        i = self._layout.index.get(key)
+        if i is not None:
+            self._values[i] = val
+            return
+        object.__setattr__(self, '_layout', self._layout.extend(key))
+        self._values.append(val)
+        if self._owner is not None:
+            self._owner._key_added(self, key)
 
     def get(self, key):
-        return self._kv[key]
+        return self._values[self._layout.index[key]]
+
+    def keys(self):
+        return self._layout.keys
+
+    def iteritems(self):
+        return iter(zip(self._layout.keys, self._values))
 
     def __setitem__(self, k, v):
         self.set(k, v)
@@ -44,43 +126,36 @@ class MdpGroup(object):
         return self.get(k)
 
     def add_comment(self, k, comment):
-        self._line_comments[k] = comment
-
-
-    def format(self):
-        with StringIO() as s:
-            s.write('; ')
-
-            # comment for this group
-            if self.descr:
-                s.write(self.descr)
-            s.write('\n')
+        if self._comments is None:
+            object.__setattr__(self, '_comments', dict())
+        self._comments[k] = comment
 
-            # the key/value pairs
-            for k, v in self._kv.iteritems():
-                s.write(k + ' = ')
 
-                ### cases: value is list of str, str, arbitrary
+    def format_header(self):
+        # comment for this group
+        return '; ' + (self.descr or '') + '\n'
 
-                # [str]: stringify
-                if type(v) is list:
-                    v_str = ' '.join(map(str, v))
-                    s.write(v_str)
+    def format_line(self, k, v=None):
+        """
+        The 'key = value' line for `k`, using `v` instead of the stored value if given
+        """
+        v = self.get(k) if v is None else v
+        line = k + ' = ' + _format_value(v)
 
-                # str: write
-                elif type(v) is str:
-                    s.write(v)
+        # add line comments
+        if self._comments and k in self._comments:
+            line += ' ; ' + str(self._comments[k])
 
-                # obj:
-                else:
-                    s.write(str(v))
+        # done
+        return line + '\n'
 
-                # add line comments
-                if k in self._line_comments:
-                    s.write(' ; ' + str(self._line_comments[k]))
+    def format(self):
+        with StringIO() as s:
+            s.write(self.format_header())
 
-                # done
-                s.write('\n')
+            # the key/value pairs
+            for k in self._layout.keys:
+                s.write(self.format_line(k))
 
             return s.getvalue()
 
@@ -88,8 +163,12 @@ class MdpGroup(object):
         return self.format()
 
     def __getattr__(self, k):
-        if k in self._kv:
-            return self._kv[k]
+        # unset slots end up here while unpickling
+        if k in MdpGroup.__slots__ or k.startswith('__'):
+            raise AttributeError, k
+        i = self._layout.index.get(k)
+        if i is not None:
+            return self._values[i]
         else: raise AttributeError, k
 
     def __deepcopy__(self, memo):
@@ -97,22 +176,75 @@ class MdpGroup(object):
         Overridding __getattr__ requires us to define our own __deepcopy__ method,
         otherwise you get a KeyError: '__deepcopy__' exception
         """
-        o = self.__class__()
-        o.__dict__.update(copy.deepcopy(self.__dict__))
+        o = self.__class__(copy.deepcopy(self.descr, memo))
+        object.__setattr__(o, '_layout', self._layout)
+        object.__setattr__(o, '_values', copy.deepcopy(self._values, memo))
+        object.__setattr__(o, '_comments', copy.deepcopy(self._comments, memo))
         return o
 
+    def __getstate__(self):
+        return self.descr, self._layout.keys, self._values, self._comments
+
+    def __setstate__(self, state):
+        descr, keys, values, comments = state
+        self.__init__(descr)
+        object.__setattr__(self, '_layout', _intern_layout(keys))
+        object.__setattr__(self, '_values', values)
+        object.__setattr__(self, '_comments', comments)
+
     def __setattr__(self, k, v):
-        if k in self.__dict__:
-            self.__dict__[k] = v
+        if k in MdpGroup.__slots__:
+            object.__setattr__(self, k, v)
         else:
-            self._kv[k] = v
+            self.set(k, v)
 
     def __contains__(self, k):
-        return k in self._kv
+        return k in self._layout.index
+
+
+def _group_name(g):
+    """
+    The name under which MDP stores the group `g`
+    """
+    return '_'.join(filter(None, g.descr.split()))
 
 
 class MDPError (Exception): pass
 
+
+class _LRUCache(object):
+    """
+    A dict holding at most `size` items, dropping the least recently used
+    """
+    def __init__(self, size):
+        self.size   = size
+        self._items = collections.OrderedDict()
+
+    def get(self, k):
+        v = self._items.pop(k)
+        self._items[k] = v
+        return v
+
+    def put(self, k, v):
+        self._items.pop(k, None)
+        self._items[k] = v
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def __contains__(self, k):
+        return k in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+# parsed MDPs by (class, sha1 of the text), see MDP.loads_cached
+MDP_CACHE_SIZE = 256
+_parsed = _LRUCache(MDP_CACHE_SIZE)
+
 class MDP(yaml.YAMLObject):
     yaml_tag = '!MDP'
 
@@ -123,26 +255,106 @@ class MDP(yaml.YAMLObject):
     @classmethod
     def from_yaml(cls, loader, node):
         s = loader.construct_python_str(node)
-        return cls.loads(s)
+        return cls.loads_cached(s)
+
+    __slots__ = ('_names', '_groups', '_index', '_index_shared', '_shared', '_exposed')
 
     def __init__(self):
-        object.__setattr__(self, '_groups', collections.OrderedDict())
+        # group names and groups, in order
+        object.__setattr__(self, '_names', ())
+        object.__setattr__(self, '_groups', list())
+        # group name or key -> position of the first group that has it
+        object.__setattr__(self, '_index', dict())
+        object.__setattr__(self, '_index_shared', False)
+        # bitmasks of the positions of groups shared with copies and of
+        # those (or their list values) handed out to callers, see copy()
+        object.__setattr__(self, '_shared', 0)
+        object.__setattr__(self, '_exposed', 0)
+
+    def _reindex(self):
+        index = dict()
+        for i, (name, g) in enumerate(zip(self._names, self._groups)):
+            index.setdefault(name, i)
+            for k in g.keys():
+                index.setdefault(k, i)
+        object.__setattr__(self, '_index', index)
+        object.__setattr__(self, '_index_shared', False)
+
+    def _writable_index(self):
+        if self._index_shared:
+            object.__setattr__(self, '_index', dict(self._index))
+            object.__setattr__(self, '_index_shared', False)
+        return self._index
+
+    def _key_added(self, g, key):
+        """
+        Called by an owned MdpGroup when it gains a new key
+        """
+        name = _group_name(g)
+        if name not in self._names or self._groups[self._names.index(name)] is not g:
+            return # no longer ours
+        i = self._index.get(key)
+        if i is None:
+            self._writable_index()[key] = self._names.index(name)
+        elif self._groups[i] is not g:
+            # the first group in order wins
+            self._reindex()
+
+    def _own(self, i):
+        """
+        Returns the group at position `i`, copying it first if it is shared
+        """
+        g = self._groups[i]
+        if self._shared & 1 << i:
+            g = copy.deepcopy(g)
+            object.__setattr__(g, '_owner', self)
+            self._groups[i] = g
+            object.__setattr__(self, '_shared', self._shared & ~(1 << i))
+        return g
+
+    def _expose(self, i):
+        object.__setattr__(self, '_exposed', self._exposed | 1 << i)
 
-    def _find_group(self, i):
-        for k, g in self._groups.iteritems():
-            if i == k or i in g:
-                return g
-        raise KeyError, i
+    def _disown(self, g):
+        if g._owner is self:
+            object.__setattr__(g, '_owner', None)
 
     def copy(self):
-        return copy.deepcopy(self)
+        """
+        Copy-on-write clone: the groups are shared between both MDPs until
+        one of them modifies (or hands out) a group, which then gets copied.
+        Groups already handed out by this MDP, directly or through a list
+        value, may still be modified by their holder, so the clone gets its
+        own copies of them right away.
+        """
+        o = self.__class__()
+        groups = list(self._groups)
+        for i, g in enumerate(groups):
+            if self._exposed & 1 << i:
+                groups[i] = copy.deepcopy(g)
+                object.__setattr__(groups[i], '_owner', o)
+        shared = (1 << len(groups)) - 1 & ~self._exposed
+        for m in self, o:
+            object.__setattr__(m, '_shared', shared)
+            object.__setattr__(m, '_index_shared', True)
+        object.__setattr__(o, '_names', self._names)
+        object.__setattr__(o, '_groups', groups)
+        object.__setattr__(o, '_index', self._index)
+        return o
 
     def get(self, k):
-        g = self._find_group(k)
+        i = self._index[k]
+        g = self._groups[i]
         if k not in g:
+            # the group itself, which the caller may modify
+            g = self._own(i)
+            self._expose(i)
             return g
-        else:
-            return g[k]
+        v = g[k]
+        if type(v) is list:
+            v = self._own(i)[k]
+            self._expose(i)
+        return v
 
     def __getitem__(self, k):
         return self.get(k)
@@ -150,10 +362,10 @@ class MDP(yaml.YAMLObject):
     def set(self, k, v, group=None):
         if group is None:
             try:
-                g = self._find_group(k)
+                g = self._own(self._index[k])
             except KeyError:
                 # TODO
-                g = self._groups[self._groups.keys()[0]]
+                g = self._own(0)
 
         g[k] = v
 
@@ -162,7 +374,7 @@ class MDP(yaml.YAMLObject):
 
     def format(self):
         with StringIO() as s:
-            for g in self._groups.itervalues():
+            for g in self._groups:
                 s.write(g.format() + '\n')
             return s.getvalue()
 
@@ -170,26 +382,65 @@ class MDP(yaml.YAMLObject):
         return self.format()
 
     def __getattr__(self, k):
+        # unset slots end up here while unpickling
+        if k in MDP.__slots__ or k.startswith('__'):
+            raise AttributeError, k
         return self.get(k)
 
     def __deepcopy__(self, memo):
         """
         Overridding __getattr__ requires us to define our own __deepcopy__ method,
-        otherwise you get a KeyError: '__deepcopy__' exception
+        otherwise you get a KeyError: '__deepcopy__' exception.
+        Modifications through either MDP, or through groups and lists
+        handed out before the copy, are independent, so the copy-on-write
+        clone is enough.
         """
-        o = self.__class__()
-        o.__dict__.update(copy.deepcopy(self.__dict__))
-        return o
+        return self.copy()
+
+    def __getstate__(self):
+        return self._names, self._groups
+
+    def __setstate__(self, state):
+        self.__init__()
+        names, groups = state
+        object.__setattr__(self, '_names', names)
+        object.__setattr__(self, '_groups', groups)
+        # the groups may be shared with other unpickled MDPs
+        object.__setattr__(self, '_shared', (1 << len(groups)) - 1)
+        self._reindex()
 
     def __setattr__(self, k, v):
-        if k in self.__dict__:
-            self.__dict__[k] = v
+        if k in MDP.__slots__:
+            object.__setattr__(self, k, v)
         else:
             self.set(k, v)
 
     def add(self, g):
-        k = '_'.join(filter(None, g.descr.split()))
-        self._groups[k] = g
+        """
+        Add the group `g`, which then belongs to this MDP.
+        A group belonging to another MDP is copied.
+        """
+        if g._owner is not None and g._owner is not self:
+            g = copy.deepcopy(g)
+        k = _group_name(g)
+        if k in self._names:
+            i = self._names.index(k)
+            self._disown(self._groups[i])
+            self._groups[i] = g
+            object.__setattr__(g, '_owner', self)
+            object.__setattr__(self, '_shared', self._shared & ~(1 << i))
+            self._expose(i) # the caller may keep `g`
+            self._reindex()
+        else:
+            object.__setattr__(g, '_owner', self)
+            i = len(self._groups)
+            object.__setattr__(self, '_names', self._names + (k,))
+            self._groups.append(g)
+            self._expose(i) # the caller may keep `g`
+            index = self._writable_index()
+            index.setdefault(k, i)
+            for key in g.keys():
+                index.setdefault(key, i)
 
     def freq(self, ps):
         """
@@ -229,9 +480,17 @@ class MDP(yaml.YAMLObject):
 
     def unset_velocity_generation(self):
         try:
-            del self._groups['VELOCITY_GENERATION']
-            logger.debug('Unsetting velocity generation')
-        except KeyError: pass
+            i = self._names.index('VELOCITY_GENERATION')
+        except ValueError: return
+        g = self._groups.pop(i)
+        object.__setattr__(self, '_names', self._names[:i] + self._names[i+1:])
+        for mask in '_shared', '_exposed':
+            bits = getattr(self, mask)
+            bits = bits & ((1 << i) - 1) | bits >> (i + 1) << i
+            object.__setattr__(self, mask, bits)
+        self._disown(g)
+        self._reindex()
+        logger.debug('Unsetting velocity generation')
 
     def seed(self, value):
         for a in 'ld_seed gen_seed'.split():
@@ -258,15 +517,49 @@ class MDP(yaml.YAMLObject):
             elif len(l) == 0:
                 continue
             k, v = map(str.strip, pair)
-            g[k] = v
+            g[intern(k)] = intern(v)
         return mdp
 
+    @classmethod
+    def loads_cached(cls, string):
+        """
+        Like loads(), but identical strings are parsed only once.  Returns a
+        copy-on-write clone of the cached MDP.
+        """
+        key = cls, hashlib.sha1(string).hexdigest()
+        try:
+            mdp = _parsed.get(key)
+        except KeyError:
+            mdp = cls.loads(string)
+            _parsed.put(key, mdp)
+        return mdp.copy()
+
     def load(self, path):
         return self.loads(open(path).read())
 
+    def content_hash(self):
+        """
+        The sha1 hex digest of the groups and their settings, ignoring
+        comments, the order of keys within a group and the formatting of
+        values
+        """
+        h = hashlib.sha1()
+        for g in self._groups:
+            h.update('; %s\n' % (g.descr or ''))
+            for k in sorted(g.keys()):
+                h.update('%s = %s\n' % (k, _canonical_value(g[k])))
+            h.update('\n')
+        return h.hexdigest()
+
     def dumps(self):
         return str(self)
 
+    def template(self, keys):
+        """
+        Compile an MDPTemplate in which only `keys` vary
+        """
+        return MDPTemplate(self, keys)
+
     def save(self, path, overwrite=True):
         if os.path.exists(path) and not overwrite:
             raise ValueError, 'Path exists: %s' % path
@@ -275,3 +568,78 @@ class MDP(yaml.YAMLObject):
             fd.write(self.format())
 
         logger.info1('Saved file %s' % os.path.abspath(path))
+
+
+class MDPTemplate(object):
+    """
+    An MDP compiled for writing many variants that differ only in a few keys.
+
+    The text of the invariant lines is rendered once; rendering a variant
+    only formats the values of the variable `keys`, which default to their
+    values in `mdp`.
+
+        t = mdp.template(['ld_seed', 'nsteps'])
+        t.save_many(('seed%d.mdp' % s, dict(ld_seed=s)) for s in seeds)
+    """
+    def __init__(self, mdp, keys):
+        keys = set(keys)
+        self.defaults = dict()
+        self._parts   = list() # str or (group, key)
+        static = list()
+        for g in mdp._groups:
+            static.append(g.format_header())
+            for k in g.keys():
+                if k in keys and k not in self.defaults:
+                    self._parts.append(''.join(static))
+                    self._parts.append((g, k))
+                    self.defaults[k] = g[k]
+                    static = list()
+                else:
+                    static.append(g.format_line(k))
+            static.append('\n')
+        self._parts.append(''.join(static))
+
+        missing = keys - set(self.defaults)
+        if missing:
+            raise MDPError, 'Unknown template keys: %s' % ', '.join(sorted(missing))
+
+    def render(self, values=None):
+        values = values or dict()
+        unknown = [k for k in values if k not in self.defaults]
+        if unknown:
+            raise MDPError, 'Not template keys: %s' % ', '.join(sorted(unknown))
+        out = list()
+        for part in self._parts:
+            if type(part) is str:
+                out.append(part)
+            else:
+                g, k = part
+                out.append(g.format_line(k, values.get(k, self.defaults[k])))
+        return ''.join(out)
+
+    def save(self, path, values=None, overwrite=True):
+        if os.path.exists(path) and not overwrite:
+            raise ValueError, 'Path exists: %s' % path
+
+        with open(path, 'w', 2**16) as fd:
+            fd.write(self.render(values))
+        return path
+
+    def save_many(self, items, threads=None, overwrite=True):
+        """
+        Write each (path, values) pair of `items`, optionally in a pool of
+        `threads`.  Returns the paths written.
+        """
+        save  = lambda item: self.save(item[0], item[1], overwrite=overwrite)
+        if threads:
+            pool = ThreadPool(threads)
+            try:
+                paths = pool.map(save, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            paths = map(save, items)
+
+        logger.info1('Saved %d files' % len(paths))
+        return paths
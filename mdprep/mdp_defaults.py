@@ -24,7 +24,7 @@ def minimize_vacuum():
     g.constraints = 'none'
     g.pbc         = 'no'
     m.add(g)
-    return m
+    return m.copy() # nothing holds the groups added above: let clones share them
 
 def minimize_solvated():
     m       = minimize_vacuum()
@@ -93,7 +93,7 @@ def explicit_solvent(velocity_generation=False):
         m.add(g)
 
 
-    return m
+    return m.copy() # nothing holds the groups added above: let clones share them
 
 def posres_explicit_solvent():
     m = explicit_solvent()
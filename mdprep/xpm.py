@@ -1,28 +1,110 @@
 import numpy as np
 import itertools
 import collections
+import copy
+import hashlib
+import mmap
+import multiprocessing
+import os
+import tempfile
+import time
 
 __all__ = ['Axis',
            'XPM',
            'XPMParser',
            'load',
-           'SSStats'
+           'XPMCache',
+           'SSStats',
+           'SSDynamics',
+           'Occupancy',
+           'XPMBlock',
+           'iterblocks',
+           'FileReport',
+           'aggregate',
        ]
 
 class Axis(object):
-    def __init__(self, size):
+    def __init__(self, size, ticks=None, values=None):
         self.size = size
-        self._i = 0
-        self.axis = np.zeros(size, dtype='S32')
+        self._i = 0 if ticks is None else size
+        self.axis = np.zeros(size, dtype='S32') if ticks is None else ticks
+        self._values = values
+        self._order = None
+
     def append(self, val):
         self.axis[self._i] = val
         self._i += 1
+        self._values = None
 
     def update(self, values):
         i = self._i
         j = i+ len(values)
         self.axis[i:j] = values
         self._i = j
+        self._values = None
+
+    def parse(self):
+        """
+        Convert the tick labels to float64 (NaN for non-numeric labels)
+        """
+        try:
+            self._values = self.axis.astype(np.float64)
+        except ValueError:
+            self._values = np.array(map(_float_or_nan, self.axis))
+        self._order = None
+        return self._values
+
+    @property
+    def values(self):
+        if self._values is None:
+            self.parse()
+        return self._values
+
+    @property
+    def order(self):
+        """
+        1 if the ticks are non-decreasing, -1 if non-increasing, 0 otherwise
+        """
+        if self._order is None:
+            delta = np.diff(self.values)
+            if   np.all(delta >= 0): self._order = 1
+            elif np.all(delta <= 0): self._order = -1
+            else:                    self._order = 0
+        return self._order
+
+    def _sorted(self):
+        if self.order == 0:
+            raise ValueError, 'Axis ticks are not monotonic'
+        return self.values if self.order > 0 else self.values[::-1]
+
+    def locate(self, value):
+        """
+        Position of the first tick at or past `value` along the axis order
+        """
+        values = self._sorted()
+        if self.order > 0:
+            return int(np.searchsorted(values, value, side='left'))
+        return self.size - int(np.searchsorted(values, value, side='right'))
+
+    def slice(self, t0=None, t1=None):
+        """
+        The slice of positions whose ticks are in [t0, t1)
+        """
+        values = self._sorted()
+        lo = 0           if t0 is None else int(np.searchsorted(values, t0, side='left'))
+        hi = len(values) if t1 is None else int(np.searchsorted(values, t1, side='left'))
+        hi = max(lo, hi)
+        if self.order > 0:
+            return slice(lo, hi)
+        return slice(self.size - hi, self.size - lo)
+
+    def window(self, s):
+        """
+        A new Axis viewing the ticks selected by the slice `s`
+        """
+        ticks  = self.axis[s]
+        values = None if self._values is None else self._values[s]
+        return Axis(len(ticks), ticks=ticks, values=values)
 
     def index(self, val):
         return self.axis == val
@@ -30,22 +112,37 @@ class Axis(object):
     def __iter__(self):
         return iter(self.axis)
 
+def _float_or_nan(s):
+    try:
+        return float(s)
+    except ValueError:
+        return np.nan
+
 class Axes(object):
     def __init__(self, **kws):
         for name, size in kws.iteritems():
             setattr(self, name, Axis(size))
 
+XPMBlock = collections.namedtuple('XPMBlock', 'start stop xtick data')
+
 class XPM(object):
-    def __init__(self, cols=0, rows=0, colors=0, char=0):
+    def __init__(self, cols=0, rows=0, colors=0, char=0, codes=False, lazy=False):
 
         self._cols     = cols
         self._rows     = rows
         self._colors   = colors
         self._char     = char
+        self._codes    = codes
+        self._keys     = list()
         self._ssmap    = dict()
         self._colormap = dict()
         self._axes     = Axes(x=cols, y=rows)
-        self._data     = np.zeros((rows,cols), dtype='S1')
+        self._mmap     = None
+        self._lut      = None # applied on access when mapping the raw file
+        if lazy:
+            self._data = None # set by XPMParser
+        else:
+            self._data = np.zeros((rows,cols), dtype='uint8' if codes else 'S1')
 
     def axis(self, name):
         return getattr(self._axes, name)
@@ -65,11 +162,80 @@ class XPM(object):
         return iter(xrange(self._cols))
 
     def __getitem__(self, column):
-        return self._data[:,column]
+        return self.pixels(cols=column)
+
+    def pixels(self, rows=slice(None), cols=slice(None)):
+        """
+        The pixels at the given row and column positions
+        """
+        values = self._data[rows,cols]
+        if self._lut is not None:
+            values = self._lut[values]
+        return values
+
+    def blocks(self, size=4096):
+        """
+        Iterate over the frames in blocks of at most `size` columns.
+        Yields XPMBlock(start, stop, xtick, data) where `data` holds the
+        (rows, stop-start) pixels.  On a lazy XPM only the pixels of the
+        current block are read.
+        """
+        for start in xrange(0, self._cols, size):
+            stop = min(start + size, self._cols)
+            yield XPMBlock(start, stop, self.x.axis[start:stop], self[start:stop])
+
+    @property
+    def lazy(self):
+        """
+        True if the pixels are served from a memory-mapped file
+        """
+        return self._mmap is not None
+
+    def occupancy(self, ss, blocksize=4096):
+        """
+        Occupancy of the states `ss` (characters) per residue, see Occupancy
+        """
+        return Occupancy(self, ss, blocksize=blocksize)
+
+    def window(self, t0=None, t1=None, axis='x'):
+        """
+        A new XPM restricted to the ticks of `axis` in [t0, t1).
+        The pixels and ticks are views of this XPM's, not copies.
+        """
+        s   = self.axis(axis).slice(t0, t1)
+        o   = copy.copy(self)
+        n   = s.stop - s.start
+        o._axes = copy.copy(self._axes)
+        setattr(o._axes, axis, self.axis(axis).window(s))
+        if axis == 'x':
+            o._cols = n
+            o._data = self._data.columns(s) if isinstance(self._data, _MappedRows) else self._data[:, s]
+        else:
+            o._rows = n
+            o._data = self._data.rows(s) if isinstance(self._data, _MappedRows) else self._data[s]
+        return o
 
     def ss(self, code):
         return self._colormap[code]
 
+    @property
+    def keys(self):
+        """
+        The pixel characters in colormap order.
+        When loaded with `codes=True` the data holds indices into this list.
+        """
+        return self._keys
+
+    @property
+    def coded(self): return self._codes
+
+    def decode(self, values):
+        """
+        Convert pixel codes back to their characters
+        """
+        if not self._codes: return values
+        return np.array(self._keys, dtype='S1')[values]
+
     @property
     def colormap(self): return self._colormap
 
@@ -77,9 +243,139 @@ class XPM(object):
     def ssmap(self): return self._ssmap
 
 
+class Occupancy(object):
+    """
+    Per-residue cumulative count of the frames spent in any of the states
+    `ss`.  The occupancy of any time window is the difference of two
+    columns, so rolling curves cost O(frames) regardless of the window width.
+    """
+    def __init__(self, xpm, ss, blocksize=4096):
+        self.times = xpm.x.values
+        if xpm.x.order <= 0 and xpm._cols > 1:
+            raise ValueError, 'Occupancy requires increasing x-axis ticks'
+        ss = set(ss)
+        if xpm.coded:
+            member = np.array([k in ss for k in xpm.keys], dtype=bool)
+        else:
+            member = np.zeros(256, dtype=bool)
+            member[[ord(k) for k in ss]] = True
+
+        self._cumsum = np.zeros((xpm._rows, xpm._cols + 1), dtype=np.int32)
+        for block in xpm.blocks(blocksize):
+            data = block.data if xpm.coded else np.asarray(block.data).view(np.uint8)
+            out  = self._cumsum[:, block.start + 1:block.stop + 1]
+            np.cumsum(member[data], axis=1, out=out)
+            out += self._cumsum[:, block.start, np.newaxis]
+
+    def window(self, t0=None, t1=None):
+        """
+        Fraction of the frames in [t0, t1) each residue spends in the states
+        """
+        i = 0               if t0 is None else np.searchsorted(self.times, t0, side='left')
+        j = len(self.times) if t1 is None else np.searchsorted(self.times, t1, side='left')
+        frames = max(j - i, 1)
+        return (self._cumsum[:, max(i, j)] - self._cumsum[:, i]) / float(frames)
+
+    def rolling(self, width):
+        """
+        The (residues x frames) occupancy over the trailing window (t - width, t].
+        The mean over axis 0 is the overall occupancy.
+        """
+        lo     = np.searchsorted(self.times, self.times - width, side='right')
+        frames = np.arange(1, len(self.times) + 1) - lo
+        return (self._cumsum[:, 1:] - self._cumsum[:, lo]) / frames.astype(np.float64)
+
+
+def _locate_rows(text, buf, rows, cols, offset=0):
+    """
+    Find the offset of the first pixel of each row in the pixel block.
+    `text` supports str.find (a str or mmap), `buf` is a uint8 array over the
+    same bytes and `offset` is where the pixel block begins.
+    Returns the offsets in file order and the stride if the layout is regular
+    (stride is None otherwise).
+    """
+    quote = ord('"')
+    start = text.find('"', offset) + 1
+    if start == 0 and rows > 0:
+        raise ValueError, 'No XPM pixel data found'
+
+    # the common case: every row is '"<pixels>",\n', so a single stride works
+    stride = cols + 1
+    if rows > 1:
+        stride = text.find('"', start + cols + 1) + 1 - start
+    starts = start + stride * np.arange(rows)
+    ends   = starts + cols
+    if stride > cols and rows > 0 and ends[-1] < len(buf) \
+       and np.all(buf[starts - 1] == quote) and np.all(buf[ends] == quote):
+        return starts, stride
+
+    # irregular layout: walk the rows one by one
+    pos = offset
+    for i in xrange(rows):
+        s = text.find('"', pos) + 1
+        if s == 0 or s + cols >= len(buf) or buf[s + cols] != quote:
+            raise ValueError, 'Malformed or truncated XPM pixel row %d' % i
+        starts[i] = s
+        pos = s + cols + 1
+    return starts, None
+
+def _pixel_rows(buf, starts, stride, cols):
+    """
+    The (rows, cols) uint8 pixel matrix in file order.
+    A view into `buf` when the layout is regular, a copy otherwise.
+    """
+    rows = len(starts)
+    if stride is not None and rows > 0:
+        return np.lib.stride_tricks.as_strided(buf[starts[0]:], shape=(rows, cols), strides=(stride, 1))
+    pixels = np.empty((rows, cols), dtype=np.uint8)
+    for i, s in enumerate(starts):
+        pixels[i] = buf[s:s+cols]
+    return pixels
+
+def _code_table(keys):
+    """
+    Lookup table from pixel byte to colormap index
+    """
+    lut = np.zeros(256, dtype=np.uint8)
+    for i, key in enumerate(keys):
+        lut[ord(key)] = i
+    return lut
+
+class _MappedRows(object):
+    """
+    Read-only (rows, cols) pixel matrix whose rows start at arbitrary offsets
+    of a memory-mapped file.  Supports the 2-d indexing used by XPM.
+    """
+    def __init__(self, buf, starts, cols, dtype):
+        self._buf   = buf
+        self._starts = starts
+        self.shape  = (len(starts), cols)
+        self.dtype  = np.dtype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def rows(self, s):
+        return _MappedRows(self._buf, self._starts[s], self.shape[1], self.dtype)
+
+    def columns(self, s):
+        return _MappedRows(self._buf, self._starts + s.start, s.stop - s.start, self.dtype)
+
+    def __getitem__(self, key):
+        rows, cols = key if type(key) is tuple else (key, slice(None))
+        offsets = np.add.outer(self._starts[rows], np.arange(self.shape[1])[cols])
+        return self._buf[offsets].view(self.dtype)
+
+    def __array__(self, dtype=None):
+        values = self[:,:]
+        return values if dtype is None else values.astype(dtype)
+
+
 class XPMParser(object):
-    def __init__(self, stream):
+    def __init__(self, stream, codes=False, lazy=False):
         self._stream = stream
+        self._codes = codes
+        self._lazy = lazy
         self._xpm = None
 
     def _parse_colormap_line(self):
@@ -129,12 +425,16 @@ class XPMParser(object):
 
         # number of columns and rows, colormap, and pixel character
         cols, rows, colors, char = map(int, line[1:-2].split())
-        self._xpm = XPM(cols=cols, rows=rows, colors=colors, char=char)
+        if char != 1:
+            raise ValueError, 'Only one character per pixel is supported, got %d' % char
+        self._xpm = XPM(cols=cols, rows=rows, colors=colors, char=char,
+                        codes=self._codes, lazy=self._lazy)
         xpm = self._xpm
 
         # parse the colormap
         for _ in xrange(xpm._colors):
             key, color, ss = self._parse_colormap_line()
+            xpm._keys.append(key)
             xpm._ssmap[key] = ss
             xpm._colormap[key] = color
 
@@ -144,42 +444,442 @@ class XPMParser(object):
             if not result: break
             axis, ticks = result
             xpm.axis(axis).update(ticks)
+        xpm.x.parse()
+        xpm.y.parse()
+
+        if self._lazy:
+            self._map_data()
+            return xpm
 
         # parse the data
-        for i, line in enumerate(itertools.imap(str.strip, self._stream)):
-            # line is formated as: ".....",
-            # ..remove the quotes and comma
-            values = line.replace('"','').replace(',','')
-            ix = rows-i-1
-            xpm._data[ix][:] = list(values)
-
-        assert i+1 == rows
+        # each line is formated as: ".....", so decode the whole block at
+        # once and strip the quotes and commas by locating the rows
+        text = self._stream.read()
+        self._stream.close()
+        buf = np.frombuffer(text, dtype=np.uint8)
+        starts, stride = _locate_rows(text, buf, rows, cols)
+        pixels = _pixel_rows(buf, starts, stride, cols)[::-1]
+
+        if self._codes:
+            xpm._data[:] = _code_table(xpm.keys)[pixels]
+        else:
+            xpm._data[:] = pixels.view('S1')
+
+        return xpm
+
+    def _map_data(self):
+        """
+        Serve the pixels from a memory map of the file instead of reading them.
+        Only the row offsets are computed here.
+        """
+        xpm = self._xpm
+        offset = self._stream.tell()
+        mm = mmap.mmap(self._stream.fileno(), 0, access=mmap.ACCESS_READ)
         self._stream.close()
+
+        buf = np.frombuffer(mm, dtype=np.uint8)
+        starts, stride = _locate_rows(mm, buf, xpm._rows, xpm._cols, offset=offset)
+        dtype = 'uint8' if self._codes else 'S1'
+        if stride is not None:
+            xpm._data = _pixel_rows(buf, starts, stride, xpm._cols)[::-1].view(dtype)
+        else:
+            xpm._data = _MappedRows(buf, starts[::-1], xpm._cols, dtype)
+        if self._codes:
+            xpm._lut = _code_table(xpm.keys)
+        xpm._mmap = mm
+
+class XPMCache(object):
+    """
+    Directory of binary (.npz) sidecars of parsed XPM files.
+
+    A sidecar is named by the content hash of its source and found through a
+    small key file named by the source path, size and mtime, so unchanged
+    files are looked up without being read.  The least recently used
+    sidecars are evicted, together with their key files, once the directory
+    holds more than `max_bytes`.
+    """
+    version = 1
+
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, name, ext):
+        return os.path.join(self.directory, name + ext)
+
+    def _stat_key(self, path):
+        st = os.stat(path)
+        key = '%s:%d:%r:%d' % (os.path.realpath(path), st.st_size, st.st_mtime, self.version)
+        return hashlib.sha1(key).hexdigest()
+
+    def _content_hash(self, path, bufsize=2**20):
+        h = hashlib.sha1(str(self.version))
+        with open(path, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(bufsize), ''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _write(self, target, writer):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                writer(stream)
+            os.rename(tmp, target)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def _lookup(self, path):
+        """
+        Returns the content hash of `path` and the sidecar path for it
+        """
+        keyfile = self._path(self._stat_key(path), '.key')
+        if os.path.exists(keyfile):
+            digest = open(keyfile).read().strip()
+        else:
+            digest = self._content_hash(path)
+            self._write(keyfile, lambda fd: fd.write(digest))
+        return digest, self._path(digest, '.npz')
+
+    def get(self, path, codes=False):
+        digest, sidecar = self._lookup(path)
+        if not os.path.exists(sidecar):
+            return None
+        os.utime(sidecar, None) # mark as recently used
+        with np.load(sidecar) as f:
+            meta = f['meta']
+            xpm = XPM(cols=meta[0], rows=meta[1], colors=meta[2], char=meta[3], codes=codes, lazy=True)
+            xpm._keys = list(f['keys'])
+            for key, color, ss in zip(xpm._keys, f['colors'], f['names']):
+                xpm._colormap[key] = color
+                xpm._ssmap[key] = ss
+            xpm.x.update(f['x'])
+            xpm.y.update(f['y'])
+            data = f['data']
+        xpm._data = data if codes else np.array(xpm._keys, dtype='S1')[data]
+        return xpm
+
+    def put(self, path, xpm):
+        digest, sidecar = self._lookup(path)
+        data = xpm[:] if xpm.coded else _code_table(xpm.keys)[np.asarray(xpm._data).view(np.uint8)]
+        meta = np.array([xpm._cols, xpm._rows, xpm._colors, xpm._char], dtype=np.int64)
+        self._write(sidecar, lambda fd: np.savez(
+            fd, meta=meta, data=data,
+            keys=np.array(xpm.keys, dtype='S1'),
+            colors=np.array([xpm.colormap[k] for k in xpm.keys]),
+            names=np.array([xpm.ssmap[k] for k in xpm.keys]),
+            x=xpm.x.axis, y=xpm.y.axis))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used sidecars and the key files pointing to
+        them until the cache fits in max_bytes.  Key files without a sidecar
+        are entries of their own.
+        """
+        entries = dict() # digest -> [mtime, size, paths]
+        for name in os.listdir(self.directory):
+            p = os.path.join(self.directory, name)
+            if name.endswith('.npz'):
+                digest = name[:-len('.npz')]
+            elif name.endswith('.key'):
+                digest = open(p).read().strip()
+            else: continue
+            st = os.stat(p)
+            e  = entries.setdefault(digest, [0, 0, list()])
+            if name.endswith('.npz') or not os.path.exists(self._path(digest, '.npz')):
+                e[0] = max(e[0], st.st_mtime)
+            e[1] += st.st_size
+            e[2].append(p)
+        total = sum(e[1] for e in entries.itervalues())
+        for _, size, paths in sorted(entries.itervalues()):
+            if total <= self.max_bytes: break
+            for p in paths:
+                if os.path.exists(p):
+                    os.unlink(p)
+            total -= size
+
+
+def load(path, codes=False, lazy=False, cache=None):
+    """
+    Parse the XPM file at `path`.
+    With `lazy=True` only the header is read and the pixels are served from a
+    memory map of the file, so files larger than memory can be sliced.
+    `cache` is an XPMCache (or a directory for one) whose sidecars are used
+    instead of parsing when the file has not changed.  It is not used for
+    lazy loads, as the sidecars hold the pixels in memory.
+    """
+    if cache is not None and not lazy:
+        cache = cache if isinstance(cache, XPMCache) else XPMCache(cache)
+        xpm = cache.get(path, codes=codes)
+        if xpm is None:
+            xpm = XPMParser(open(path), codes=codes, lazy=lazy).parse()
+            cache.put(path, xpm)
         return xpm
+    return XPMParser(open(path), codes=codes, lazy=lazy).parse()
 
-def load(path):
-    return XPMParser(open(path)).parse()
+def iterblocks(path, size=4096, codes=False):
+    """
+    Stream the frames of the XPM file at `path` in blocks of `size` columns.
+    The file is memory-mapped so memory use is bounded by the block size.
+    """
+    return load(path, codes=codes, lazy=True).blocks(size)
 
 
-class SSStats(object):
+class _Index(object):
+    """
+    Assigns consecutive positions to keys in order of first appearance
+    """
     def __init__(self):
-        self._param = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
+        self._pos = dict()
+
+    def __len__(self):
+        return len(self._pos)
+
+    def positions(self, keys):
+        pos = np.empty(len(keys), dtype=np.intp)
+        for i, k in enumerate(keys):
+            p = self._pos.get(k)
+            if p is None:
+                p = len(self._pos)
+                self._pos[k] = p
+            pos[i] = p
+        return pos
+
+    def keys(self):
+        """
+        The keys by position, as int64 if they are all whole numbers
+        """
+        keys = np.empty(len(self._pos), dtype=np.float64)
+        for k, p in self._pos.iteritems():
+            keys[p] = k
+        if np.all(keys == np.round(keys)):
+            keys = keys.astype(np.int64)
+        return keys
+
+    def iteritems(self):
+        return self._pos.iteritems()
+
+
+class _SSCodes(object):
+    """
+    Maps ss characters to small integer codes in order of first appearance
+    """
+    def __init__(self):
+        self._codes = list()                           # code -> ss character
+        self._lut   = np.zeros(256, dtype=np.intp) - 1 # ss byte -> code
         self.ssmap = dict()
         self.colormap = dict()
 
+    @property
+    def codes(self): return self._codes
+
+    def _code(self, ss):
+        code = self._lut[ord(ss)]
+        if code < 0:
+            code = len(self._codes)
+            self._codes.append(ss)
+            self._lut[ord(ss)] = code
+            self._new_code(code)
+        return code
+
+    def _new_code(self, code):
+        pass
+
+    def _encode(self, values):
+        values = np.asarray(values, dtype='S1').view(np.uint8)
+        codes  = self._lut[values]
+        if np.any(codes < 0):
+            for byte in np.unique(values[codes < 0]):
+                self._code(chr(byte))
+            codes = self._lut[values]
+        return codes
+
+    def _decoder(self, xpm):
+        """
+        Function converting pixels of `xpm` into codes
+        """
+        self.colormap.update(xpm.colormap)
+        self.ssmap.update(xpm.ssmap)
+        if not xpm.coded:
+            return self._encode
+        table = np.array([self._code(k) for k in xpm.keys], dtype=np.intp)
+        return lambda data: table[data]
+
+    def _merge_codes(self, other):
+        """
+        Translation table from the codes of `other` to the codes of this instance
+        """
+        self.colormap.update(other.colormap)
+        self.ssmap.update(other.ssmap)
+        return np.array([self._code(ss) for ss in other.codes], dtype=np.intp)
+
+
+class SSStats(_SSCodes):
+    """
+    Secondary structure counts per time key.
+
+    The counts are kept in a (time key x ss code) array where the time keys
+    and the ss characters are mapped to rows and columns on first sight.
+    """
+    def __init__(self):
+        _SSCodes.__init__(self)
+        self._rows   = _Index()                        # time key -> row
+        self._counts = np.zeros((0, 0), dtype=np.int64)
+        self._cumulative = None                        # see _cumsum
+
+    @property
+    def counts(self):
+        """
+        The (time key x ss code) count array, see `keys` and `codes` for the labels
+        """
+        return self._counts[:len(self._rows)]
+
+    @property
+    def keys(self):
+        return self._rows.keys()
+
+    def _new_code(self, code):
+        self._grow(self._counts.shape[0], code + 1)
+
+    def _grow(self, nrows, ncols):
+        self._cumulative = None
+        shape = self._counts.shape
+        if nrows <= shape[0] and ncols <= shape[1]: return
+        if nrows > shape[0]:
+            nrows = max(nrows, 2 * shape[0])
+        counts = np.zeros((nrows, max(ncols, shape[1])), dtype=np.int64)
+        counts[:shape[0], :shape[1]] = self._counts
+        self._counts = counts
+
+    def _key_rows(self, keys):
+        rows = self._rows.positions(keys)
+        self._grow(len(self._rows), len(self._codes))
+        return rows
+
+    def _add(self, keys, codes):
+        """
+        keys  :: (cols,) time keys
+        codes :: (rows, cols) column indices into the count array
+        """
+        uniq, inverse = np.unique(self._key_rows(keys), return_inverse=True)
+        ncodes = self._counts.shape[1]
+        flat   = inverse[np.newaxis, :] * ncodes + codes
+        counts = np.bincount(flat.ravel(), minlength=len(uniq) * ncodes)
+        self._counts[uniq] += counts.reshape(len(uniq), ncodes)
+        self._cumulative = None
+
     def update(self, key, sslist):
-        for ss in sslist:
-            self._param[key][ss] += 1
+        if isinstance(sslist, str):
+            sslist = list(sslist)
+        codes = self._encode(sslist)
+        self._add([key], codes.reshape(-1, 1))
+
+    def update_block(self, keys, block):
+        """
+        Add a (rows, cols) block of ss characters where column `i` belongs to `keys[i]`
+        """
+        self._add(keys, self._encode(block))
+
+    def accumulate(self, xpm, blocksize=4096):
+        """
+        Add every frame of `xpm`, `blocksize` columns at a time
+        """
+        decode = self._decoder(xpm)
+        keys   = xpm.x.values
+        if np.any(np.isnan(keys)):
+            raise ValueError, 'Non-numeric x-axis ticks'
+        if np.all(keys == np.round(keys)):
+            keys = keys.astype(np.int64)
+        for block in xpm.blocks(blocksize):
+            self._add(keys[block.start:block.stop], decode(block.data))
+
+    def merge(self, other):
+        """
+        Add the counts of `other` into this instance and return it.
+        Time keys and ss characters are matched by value, so partials built
+        independently (e.g. in different processes) combine in any order.
+        """
+        cols = self._merge_codes(other)
+        rows = self._key_rows(other.keys)
+        if len(rows) and len(cols):
+            self._counts[rows[:, np.newaxis], cols] += other.counts[:, :len(cols)]
+        self._cumulative = None
+        return self
+
+    def _cumsum(self):
+        """
+        The sorted time keys and the (keys + 1 x codes) cumulative counts
+        along them, so the counts over keys[i:j] are C[j] - C[i]
+        """
+        if self._cumulative is None:
+            keys   = self.keys
+            order  = np.argsort(keys)
+            counts = np.zeros((len(keys) + 1, self._counts.shape[1]), dtype=np.int64)
+            np.cumsum(self.counts[order], axis=0, out=counts[1:])
+            self._cumulative = keys[order], counts
+        return self._cumulative
+
+    def window(self, t0=None, t1=None):
+        """
+        The ss counts over the time keys in [t0, t1) as {ss: count}
+        """
+        keys, cumulative = self._cumsum()
+        i = 0         if t0 is None else np.searchsorted(keys, t0, side='left')
+        j = len(keys) if t1 is None else np.searchsorted(keys, t1, side='left')
+        counts = cumulative[max(i, j)] - cumulative[i]
+        return dict((self._codes[c], int(counts[c])) for c in np.flatnonzero(counts))
+
+    def rolling(self, width):
+        """
+        Occupancy over a trailing window of `width` time units.
+        Returns the sorted time keys and the (keys x codes) fraction of
+        residues x frames in each state within (key - width, key].
+        """
+        keys, cumulative = self._cumsum()
+        lo     = np.searchsorted(keys, keys - width, side='right')
+        counts = cumulative[1:] - cumulative[lo]
+        return keys, counts / counts.sum(axis=1)[:, np.newaxis].astype(np.float64)
 
     def stats(self):
         stats = dict()
-        for k, info in self._param.iteritems():
+        counts = self._counts
+        for k, row in self._rows.iteritems():
             stats[k] = dict()
-            for ss, count in info.iteritems():
-                stats[k][ss] = count
+            for col in np.flatnonzero(counts[row]):
+                stats[k][self._codes[col]] = int(counts[row, col])
         return stats
 
-    def plot(self, path, only=None, title=None):
+    def percentages(self):
+        """
+        The time keys in increasing order and the matching (keys x codes)
+        matrix of percentages, one column per entry of `codes`
+        """
+        keys   = self.keys
+        order  = np.argsort(keys)
+        counts = self.counts[order]
+        totals = counts.sum(axis=1)
+        return keys[order], 100 * counts / totals[:, np.newaxis].astype(np.float64)
+
+    def _bin(self, xaxis, bins):
+        """
+        Start positions of `bins` equal-width bins over the sorted `xaxis`
+        """
+        span = xaxis[-1] - xaxis[0]
+        if span == 0: return np.zeros(1, dtype=np.intp)
+        ix = ((xaxis - xaxis[0]) * bins / span).astype(np.intp).clip(0, bins - 1)
+        return np.concatenate(([0], np.flatnonzero(np.diff(ix)) + 1))
+
+    def plot(self, path, only=None, title=None, bins=None, envelope=False):
+        """
+        Plot the frame count and percentage of each ss type over time.
+
+        With `bins` the time axis is decimated to at most that many bins:
+        each bin shows the frame-weighted mean percentage and, if `envelope`
+        is set, the band between the minimum and maximum within the bin.
+        """
         import matplotlib
         matplotlib.use('Agg')
         import matplotlib.pyplot as plt
@@ -189,18 +889,38 @@ class SSStats(object):
         rmap  = dict([(v,k) for (k,v) in self.ssmap.iteritems()])
         only  = set([rmap.get(name) for name in _only])
 
+        # collapse the ss codes that are not requested into 'other'
+        counts  = self.counts
+        seen    = counts.sum(axis=0) > 0
+        columns = dict()
+        other   = [i for i, ss in enumerate(self._codes) if seen[i] and ss not in only]
+        for i, ss in enumerate(self._codes):
+            if seen[i] and ss in only: columns[ss] = [i]
+        if other: columns['other'] = other
+        names   = columns.keys()
+
+        order   = np.argsort(self.keys)
+        xaxis   = self.keys[order].astype(np.float64)
+        counts  = counts[order]
+        grouped = np.column_stack([counts[:, columns[n]].sum(axis=1) for n in names]) \
+                  if names else np.zeros((len(xaxis), 0))
+        totals  = counts.sum(axis=1)
+        width   = 1
 
-        stats   = self.stats()
-        xaxis   = np.array(sorted(stats.keys()))
-        totals  = np.zeros(len(xaxis))
-        ss_perc = collections.defaultdict(lambda: np.zeros(len(xaxis)))
-        for i, x in enumerate(xaxis):
-            total = sum(stats[x].values())
-            totals[i] = total
-            for ss, count in stats[x].iteritems():
-                if ss in only: name = ss
-                else:          name = 'other'
-                ss_perc[name][i] += 100 * count / float(total)
+        if bins is not None and len(xaxis) > bins:
+            starts = self._bin(xaxis, bins)
+            perc   = 100 * grouped / totals[:, np.newaxis].astype(np.float64)
+            lo     = np.minimum.reduceat(perc, starts, axis=0)
+            hi     = np.maximum.reduceat(perc, starts, axis=0)
+            width  = (xaxis[-1] - xaxis[0]) / float(bins) / 10.**3
+            xaxis  = np.add.reduceat(xaxis, starts) / np.diff(np.append(starts, len(xaxis)))
+            grouped = np.add.reduceat(grouped, starts, axis=0)
+            totals  = np.add.reduceat(totals, starts)
+        else:
+            envelope = False
+
+        ss_perc = 100 * grouped / totals[:, np.newaxis].astype(np.float64)
+        ss_perc = dict((n, ss_perc[:, i]) for i, n in enumerate(names))
         self.colormap['other'] = 'black'
         self.ssmap['other'] = 'other'
 
@@ -211,7 +931,7 @@ class SSStats(object):
         plt.subplot(gs[0])
         plt.title(title)
         ax = plt.gca()
-        plt.bar(xaxis, totals, 1, color='grey', alpha=.5)
+        plt.bar(xaxis, totals, width, color='grey', alpha=.5)
         ax.yaxis.tick_right()
         ax.yaxis.set_label_position('right')
         plt.ylabel('#')
@@ -229,6 +949,9 @@ class SSStats(object):
             style = ':' if color is 'black' else '-'
             plt.plot(xaxis, ss_perc[ss], linestyle=style,
                        color=color, label=self.ssmap[ss], lw=3, alpha=.6)
+            if envelope:
+                i = names.index(ss)
+                plt.fill_between(xaxis, lo[:, i], hi[:, i], color=color, alpha=.2, lw=0)
 
         plt.ylabel('%')
         plt.xlabel('Time (ns)')
@@ -241,15 +964,183 @@ class SSStats(object):
         plt.savefig(path, bbox_inches='tight')
 
 
+class SSDynamics(_SSCodes):
+    """
+    Per-residue secondary structure transition counts and the distribution
+    of state lifetimes (in frames), accumulated over one or more XPM files.
+
+    Residues are identified by their y-axis tick.  Each residue's time series
+    is run-length encoded, so a run is a maximal stretch of frames in the
+    same state.  Runs touching the first or last frame of a file are
+    truncated by the trajectory; pass `censor=True` to `accumulate` to leave
+    them out of the lifetimes.
+    """
+    def __init__(self):
+        _SSCodes.__init__(self)
+        self._residues    = _Index()                           # y tick -> row
+        self._transitions = np.zeros((0, 0, 0), dtype=np.int64) # residue x from x to
+        self._lifetimes   = np.zeros((0, 1), dtype=np.int64)    # code x run length
+
+    @property
+    def residues(self):
+        return self._residues.keys()
+
+    @property
+    def transitions(self):
+        """
+        The (residue x from code x to code) count of frame-to-frame transitions
+        """
+        return self._transitions[:len(self._residues)]
+
+    @property
+    def lifetimes(self):
+        """
+        The (code x run length) count of runs, column `n` holds runs of `n` frames
+        """
+        return self._lifetimes
+
+    def mean_lifetime(self, ss):
+        """
+        Mean length in frames of the runs in state `ss`
+        """
+        code = self._lut[ord(ss)]
+        if code < 0: return np.nan
+        hist = self._lifetimes[code]
+        runs = hist.sum()
+        return np.nan if runs == 0 else np.dot(hist, np.arange(len(hist))) / float(runs)
+
+    def _new_code(self, code):
+        self._grow(self._transitions.shape[0], code + 1, self._lifetimes.shape[1])
+
+    def _grow(self, nres, ncodes, nlengths):
+        t = self._transitions
+        if nres > t.shape[0] or ncodes > t.shape[1]:
+            shape = max(nres, t.shape[0]), max(ncodes, t.shape[1]), max(ncodes, t.shape[2])
+            self._transitions = np.zeros(shape, dtype=np.int64)
+            self._transitions[:t.shape[0], :t.shape[1], :t.shape[2]] = t
+        l = self._lifetimes
+        if ncodes > l.shape[0] or nlengths > l.shape[1]:
+            self._lifetimes = np.zeros((max(ncodes, l.shape[0]), max(nlengths, l.shape[1])), dtype=np.int64)
+            self._lifetimes[:l.shape[0], :l.shape[1]] = l
+
+    def _add(self, residues, codes, censor=False):
+        """
+        residues :: (rows,) y ticks
+        codes    :: (rows, cols) ss codes
+        """
+        rows = self._residues.positions(residues)
+        self._grow(len(self._residues), len(self._codes), 1)
+        nres, nframes = codes.shape
+        ncodes = self._transitions.shape[1]
+        if nres == 0 or nframes == 0: return
+
+        # transitions between consecutive frames of each residue, summing
+        # rows that share a y tick (eg residue numbers repeated per chain)
+        prev, curr = codes[:, :-1], codes[:, 1:]
+        uniq, inverse = np.unique(rows, return_inverse=True)
+        flat = (inverse[:, np.newaxis] * ncodes + prev) * ncodes + curr
+        counts = np.bincount(flat.ravel(), minlength=len(uniq) * ncodes * ncodes)
+        self._transitions[uniq] += counts.reshape(len(uniq), ncodes, ncodes)
+
+        # run-length encode all residues at once, a run starts at every
+        # state change and at the first frame of each residue
+        begins = np.ones(codes.shape, dtype=bool)
+        begins[:, 1:] = prev != curr
+        starts  = np.flatnonzero(begins.ravel())
+        lengths = np.diff(np.append(starts, codes.size))
+        states  = codes.ravel()[starts]
+        if censor:
+            column = starts % nframes
+            keep   = (column != 0) & (column + lengths != nframes)
+            lengths, states = lengths[keep], states[keep]
+        if len(lengths) == 0: return
+        self._grow(0, ncodes, lengths.max() + 1)
+        width  = self._lifetimes.shape[1]
+        counts = np.bincount(states * width + lengths, minlength=ncodes * width)
+        self._lifetimes[:ncodes] += counts.reshape(ncodes, width)
+
+    def accumulate(self, xpm, blocksize=64, censor=False):
+        """
+        Add every residue of `xpm`, `blocksize` residues at a time
+        """
+        decode   = self._decoder(xpm)
+        residues = xpm.y.values.astype(np.int64)
+        for start in xrange(0, xpm._rows, blocksize):
+            stop = min(start + blocksize, xpm._rows)
+            data = xpm.pixels(rows=slice(start, stop))
+            self._add(residues[start:stop], decode(data), censor=censor)
+
+    def merge(self, other):
+        """
+        Add the counts of `other` into this instance and return it
+        """
+        codes = self._merge_codes(other)
+        rows  = self._residues.positions(other.residues)
+        width = other.lifetimes.shape[1]
+        self._grow(len(self._residues), len(self._codes), width)
+        n = len(codes)
+        if len(rows) and n:
+            self._transitions[rows[:, np.newaxis, np.newaxis], codes[:, np.newaxis], codes] += other.transitions[:, :n, :n]
+        if n:
+            self._lifetimes[codes, :width] += other.lifetimes[:n]
+        return self
+
+
+FileReport = collections.namedtuple('FileReport', 'path frames nbytes seconds')
+
+def _accumulate_paths(args):
+    paths, kind, kws = args
+    stats   = kind()
+    reports = list()
+    for path in paths:
+        t0  = time.time()
+        xpm = load(path, **kws)
+        stats.accumulate(xpm)
+        reports.append(FileReport(path, xpm._cols, os.path.getsize(path), time.time() - t0))
+    return stats, reports
+
+def aggregate(paths, processes=None, codes=True, lazy=False, kind=SSStats):
+    """
+    Accumulate the SSStats of many XPM files in a pool of `processes` workers.
+    Each worker builds one partial SSStats over its share of `paths` and the
+    partials are combined with SSStats.merge.
+    `kind` may be any class with `accumulate` and `merge`, e.g. SSDynamics.
+    Returns the merged result and a FileReport per path.
+    """
+    paths     = list(paths)
+    processes = processes or multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(paths)))
+    kws       = dict(codes=codes, lazy=lazy)
+    work      = [(paths[i::processes], kind, kws) for i in xrange(processes)]
+
+    if processes == 1:
+        partials = itertools.imap(_accumulate_paths, work)
+        pool     = None
+    else:
+        pool     = multiprocessing.Pool(processes)
+        partials = pool.imap_unordered(_accumulate_paths, work)
+
+    stats   = kind()
+    reports = list()
+    try:
+        for partial, rs in partials:
+            stats.merge(partial)
+            reports.extend(rs)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return stats, reports
+
+
 if __name__ == '__main__':
     import sys
     paths = sys.argv[1:]
 
-    stats = SSStats()
-    for xpm in itertools.imap(load, paths):
-        for ix in xpm:
-            stats.update(int(xpm.xtick(ix)), xpm[ix])
-            stats.colormap.update(xpm.colormap)
-            stats.ssmap.update(xpm.ssmap)
+    stats, reports = aggregate(paths)
+    for r in reports:
+        print >>sys.stderr, '%s: %d frames in %.2fs (%.1f frames/s, %.1f MB/s)' % (
+            r.path, r.frames, r.seconds,
+            r.frames / max(r.seconds, 1e-9), r.nbytes / max(r.seconds, 1e-9) / 2.**20)
 
     stats.plot('test.svg', only='B-Bridge B-Sheet Bend Turn'.split())